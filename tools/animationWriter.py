@@ -6,17 +6,26 @@ __version__ = "0.1"
 
 '''
 takes input graphics files(usually png), converts and packs them into animation file
-first file determines palette to use
-nice2have:
-  -calculate required palettes, insert new palettes as needed
-    -start at first palette, keep in buffer, save there
-    -if buffer satisfies subsequent frame, use buffer there aswell. else replace buffer
-    
-  -somehow decide between frame tile uploads and packing all tiles into one tileset
+palettes are planned across all frames, see -paletteplan.
 
 command line options:
 -infolder    input folder containing all animation frames, name-sorted
 -outfile    output animation file
+-jobs       worker processes parsing & optimizing frames, 0 uses all cores(default: 1)
+-delta      reuse tiles already in vram instead of uploading them again(default: off):
+              off: every frame uploads its own tiles
+              subset: frames whose tiles are all part of the last upload get an empty tile block
+              shared: one tileset holding the distinct tiles of all frames is uploaded with first frame,
+                      all other frames get an empty tile block. limited to 1024 tiles, 512 in sprite mode
+            delta frames depend on the tiles uploaded by preceding frames, so they are only valid
+            when the animation is played back sequentially. first frame always uploads tiles, so looping is fine.
+-paletteplan how palettes of frames are determined(default: first):
+              first: palettes of first frame are used for all frames
+              global: palettes are built from color histogram of all frames, of similar colors the less frequent is dropped
+              insert: palettes of first frame are kept as long as they satisfy subsequent frames. frames with colors
+                      further off than -palettethreshold replace them with their own palettes, uploaded with that frame.
+                      like delta frames, this relies on sequential playback
+-palettethreshold  max square error of color to nearest palette entry satisfying paletteplan insert(default: 0, exact)
 
 outfile format:
 [sprite_animation{
@@ -46,6 +55,9 @@ import os
 import sys
 import math
 import time
+import itertools
+import collections
+import numpy as np
 import userOptions
 import gracon
 import logging
@@ -67,6 +79,11 @@ HEADER_MAGIC = b'SP'
 HEADER_SIZE = 9
 FRAME_HEADER_SIZE = 6
 ALLOWED_FRAME_FILETYPES = ('.png', '.gif', '.bmp')
+DELTA_MODES = ('off', 'subset', 'shared')
+PALETTE_PLANS = ('first', 'global', 'insert')
+# bg tilemap entries address 10 bit tile ids, oam entries 9 bit tile ids(8 bit tile & name table bit)
+MAX_SHARED_TILES = 0x400
+MAX_SHARED_SPRITE_TILES = 0x200
 
 
 def main():
@@ -95,6 +112,10 @@ def main():
             'value': '',
             'type': 'str'
         },
+        'quantizer': {
+            'value': 'adaptive',
+            'type': 'str'
+        },
         'tilesizex': {
             'value': 8,
             'type': 'int',
@@ -149,6 +170,38 @@ def main():
             'max': 0xffff,
             'min': 1
         },
+        'jobs': {
+            'value': 1,
+            'type': 'int',
+            'max': 255,
+            'min': 0
+        },
+        'profile': {
+            'value': '',
+            'type': 'str'
+        },
+        'cprofile': {
+            'value': False,
+            'type': 'bool'
+        },
+        'tracemalloc': {
+            'value': False,
+            'type': 'bool'
+        },
+        'delta': {
+            'value': 'off',
+            'type': 'str'
+        },
+        'paletteplan': {
+            'value': 'first',
+            'type': 'str'
+        },
+        'palettethreshold': {
+            'value': 0,
+            'type': 'int',
+            'max': 0xffff,
+            'min': 0
+        },
     })
 
     if not os.path.exists(options.get('infolder')):
@@ -156,6 +209,16 @@ def main():
                       options.get('infolder'))
         sys.exit(1)
 
+    if options.get('delta') not in DELTA_MODES:
+        logging.error('Error, invalid delta mode "%s", must be one of %s.' % (
+            options.get('delta'), ', '.join(DELTA_MODES)))
+        sys.exit(1)
+
+    if options.get('paletteplan') not in PALETTE_PLANS:
+        logging.error('Error, invalid palette plan "%s", must be one of %s.' % (
+            options.get('paletteplan'), ', '.join(PALETTE_PLANS)))
+        sys.exit(1)
+
     '''
   options.manualSet('tilesizex', 8)
   options.manualSet('tilesizey', 8)
@@ -163,59 +226,275 @@ def main():
   options.manualSet('mode', 'sprite')
   '''
 
+    profiler = gracon.StageProfiler(options.get('infolder'))
+    hooks = gracon.startProfilingHooks(options)
+    try:
+        convertAnimation(options, profiler)
+    finally:
+        gracon.stopProfilingHooks(hooks, '%s.prof' % options.get('outfile'))
+    gracon.writeProfileRecords(profiler.records, options)
+
+
+def convertAnimation(options, profiler):
+    '''
+    converts frames one at a time and streams them to the output file, so memory use does not grow with animation length.
+    frame count is known upfront, so frames are written behind the space reserved for header & pointer table,
+    which are filled in once all frame sizes are known.
+    '''
     # tileFrames = sorted([gracon.parseTiles(gracon.getInputImage(options, "%s/%s" % (options.get('infolder'), frame)), options) for root, dirs, names in os.walk(options.get('infolder')) for frame in names if os.path.splitext(frame)[1] in ALLOWED_FRAME_FILETYPES], key=lambda frame: frame)
     tileFiles = [frame for root, dirs, names in os.walk(options.get(
         'infolder')) for frame in names if os.path.splitext(frame)[1] in ALLOWED_FRAME_FILETYPES]
     tileFiles.sort()
-    tileFrames = [gracon.parseTiles(gracon.getInputImage(
-        options, "%s/%s" % (options.get('infolder'), frame)), options) for frame in tileFiles]
 
-    if not 0 < len(tileFrames):
+    if not 0 < len(tileFiles):
         logging.error(
             'Error, input folder "%s" does not contain any parseable frame image files.' % options.get('infolder'))
         sys.exit(1)
 
-    palette = gracon.parseGlobalPalettes(tileFrames[0], options)
+    # incomplete animation must not replace previous output file
+    tempFileName = '%s.%s.tmp' % (options.get('outfile'), os.getpid())
+    try:
+        outFile = open(tempFileName, 'wb')
+    except IOError:
+        logging.error('unable to access required output-file %s' %
+                      options.get('outfile'))
+        sys.exit(1)
 
-    tileFrames = [gracon.augmentOutIds(gracon.optimizeTiles(
-        gracon.palettizeTiles(frame, palette), options)) for frame in tileFrames]
+    frameJobs = [(options, "%s/%s" % (options.get('infolder'), frame)) for frame in tileFiles]
+    processCount = min(options.get('jobs') or os.cpu_count() or 1, len(frameJobs))
+    if processCount > 1:
+        logging.info('converting %s frames with %s processes.' % (len(frameJobs), processCount))
+        import multiprocessing
+        pool = multiprocessing.Pool(processCount)
+    else:
+        pool = None
 
+    try:
+        with outFile:
+            parsedFrames = mapFrames(pool, parseFrame, frameJobs, processCount)
+
+            # workers keep parsing subsequent frames while palettes are planned
+            with profiler.stage('palette', 'First frame parsed, global palettes planned') as record:
+                firstFrame = getFrameResult(next(parsedFrames))
+                framePalettes = planFramePalettes(firstFrame[0], frameJobs, pool, processCount, options)
+                record['palettes'] = max(len(palette) for palette in framePalettes)
+                record['paletteUploads'] = sum(1 for frameId in range(len(framePalettes))
+                                               if isPaletteUpload(framePalettes, frameId))
+
+            with profiler.stage('convert', 'Frames parsed, optimized, encoded and written') as record:
+                optimizeJobs = ((getFrameResult(frame), palette, options)
+                                for frame, palette in zip(itertools.chain([firstFrame], parsedFrames), framePalettes))
+                outFile.seek(HEADER_SIZE + len(frameJobs) * 2)
+                framePointers = []
+                maxTileLength = 0
+                maxPaletteLength = 0
+                record['tiles'] = 0
+                uploads = TileUploads(options.get('delta'), MAX_SHARED_SPRITE_TILES if options.get(
+                    'mode') == 'sprite' else MAX_SHARED_TILES)
+                for frameId, optimizedFrame in enumerate(mapFrames(pool, optimizeFrame, optimizeJobs, processCount)):
+                    tileFrame, resolution = getFrameResult(optimizedFrame)
+                    # frame was parsed by worker, which set resolution on its own copy of options only
+                    setFrameResolution(options, resolution)
+                    # palettes are appended to frames that switch palettes only
+                    palette = framePalettes[frameId]
+                    framePalette = palette if isPaletteUpload(framePalettes, frameId) and not options.get('directcolor') else []
+                    frame = getFrameStreams(tileFrame, palette, framePalette, uploads, options)
+                    record['tiles'] += tileFrame.actualCount()
+                    if frameId == 0 and uploads.mode == 'shared':
+                        # shared tileset is complete once all frames are encoded, first frame is written last
+                        firstFrame = frame
+                        framePointers.append(None)
+                        continue
+                    framePointers.append(outFile.tell())
+                    writeFrame(outFile, frame)
+                    maxTileLength = max(maxTileLength, len(frame[0]))
+                    maxPaletteLength = max(maxPaletteLength, len(frame[2]))
+
+                if uploads.mode == 'shared':
+                    firstFrame = (uploads.getSharedTiles(),) + firstFrame[1:]
+                    framePointers[0] = outFile.tell()
+                    writeFrame(outFile, firstFrame)
+                    maxTileLength = max(maxTileLength, len(firstFrame[0]))
+                    maxPaletteLength = max(maxPaletteLength, len(firstFrame[2]))
+                record['frames'] = len(framePointers)
+                record['bytes'] = outFile.tell()
+                record['uploadBytes'] = uploads.uploadBytes
+                record['savedBytes'] = uploads.savedBytes
+                if uploads.mode != 'off':
+                    logging.info('delta %s: %s of %s frames skip tile uploads, tile uploads reduced by %s to %s bytes.' % (
+                        uploads.mode, uploads.deltaFrames, len(framePointers), uploads.savedBytes, uploads.uploadBytes))
+
+            with profiler.stage('write', 'Animation file written'):
+                writeHeader(outFile, maxTileLength, maxPaletteLength, framePointers, options)
+        os.replace(tempFileName, options.get('outfile'))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if os.path.exists(tempFileName):
+            os.remove(tempFileName)
+
+    logging.info('Successfully wrote animation file %s.' %
+                 options.get('outfile'))
+
+
+def planFramePalettes(firstFrame, frameJobs, pool, processCount, options):
+    '''
+    returns palettes of each frame according to -paletteplan. frames keeping the palettes of their predecessor share them.
+    colors of all frames are collected in an extra parsing pass, so frames need not be kept in memory.
+    '''
+    firstPalette = gracon.augmentOutIds(gracon.parseGlobalPalettes(firstFrame, options))
+    if options.get('paletteplan') == 'first' or options.get('refpalette') or len(frameJobs) < 2:
+        return [firstPalette] * len(frameJobs)
+
+    histograms = [firstFrame.getColorHistogram()] + [getFrameResult(histogram) for histogram in mapFrames(
+        pool, getFrameHistogram, frameJobs[1:], processCount)]
+    frameIds = np.repeat(np.arange(len(histograms)), [len(colors) for colors, counts in histograms])
+    colors = np.concatenate([colors for colors, counts in histograms]).astype(np.int64)
+    counts = np.concatenate([counts for colors, counts in histograms])
+
+    if options.get('paletteplan') == 'global':
+        # shared histogram of all frames, colors in order of first appearance in animation
+        distinctColors, firstIndices, colorIds = np.unique(colors, return_index=True, return_inverse=True)
+        order = np.argsort(firstIndices)
+        pixelCounts = np.bincount(colorIds, weights=counts)
+        palette = gracon.augmentOutIds(gracon.parseHistogramPalettes(
+            distinctColors[order].tolist(), pixelCounts[order].tolist(), options))
+        return [palette] * len(frameJobs)
+
+    # each pass matches colors of all remaining frames against current palettes at once,
+    # up to first frame that is not satisfied. that frame's own palettes replace current ones
+    framePalettes = [firstPalette]
+    while len(framePalettes) < len(frameJobs):
+        currentPalette = framePalettes[-1]
+        pending = frameIds >= len(framePalettes)
+        errors = getPaletteErrors(colors[pending], currentPalette)
+        unsatisfied = frameIds[pending][errors > options.get('palettethreshold')]
+        nextFrameId = int(unsatisfied[0]) if len(unsatisfied) else len(frameJobs)
+        framePalettes += [currentPalette] * (nextFrameId - len(framePalettes))
+        if nextFrameId < len(frameJobs):
+            frameColors = colors[frameIds == nextFrameId]
+            palette = gracon.augmentOutIds(gracon.parseHistogramPalettes(frameColors.tolist(), None, options))
+            # frame with more colors than palettes hold may be matched no better by its own palettes
+            currentError = errors[frameIds[pending] == nextFrameId].max()
+            framePalettes.append(palette if getPaletteErrors(frameColors, palette).max() < currentError else currentPalette)
+    return framePalettes
+
+
+def getPaletteErrors(colors, palettes):
+    '''square error of each color to nearest entry of any palette'''
+    entries = np.array([color for palette in palettes for color in palette['color']], dtype=np.int64)
+    return gracon.getColorSquareErrors(colors[:, np.newaxis], entries[np.newaxis, :]).min(axis=1)
+
+
+def isPaletteUpload(framePalettes, frameId):
+    '''first frame and frames switching palettes upload them'''
+    return frameId == 0 or framePalettes[frameId] is not framePalettes[frameId - 1]
+
+
+def getFrameStreams(tileFrame, palette, framePalette, uploads, options):
+    '''returns (tiles, tilemap, palette) bytes of single frame'''
     tileMapGetter = gracon.getSpriteTileMapStream if options.get(
         'mode') == 'sprite' else gracon.getBgTileMapStream
+    # tile ids may be remapped to tiles in vram, so tilemap has to be encoded afterwards
+    tiles = uploads.assign(tileFrame, getBlockBytes(gracon.getTileWriteStream(tileFrame, options)))
+    return tuple([tiles] + [getBlockBytes(block) for block in (tileMapGetter(
+        tileFrame, palette, options), gracon.getPaletteWriteStream(framePalette, options))])
 
-    palette = gracon.augmentOutIds(palette)
-    frames = [(gracon.getTileWriteStream(tileFrame, options), tileMapGetter(
-        tileFrame, palette, options), gracon.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
-
-    # append palette to first
-    if not options.get('directcolor'):
-        frames[0] = (gracon.getTileWriteStream(tileFrames[0], options), tileMapGetter(
-            tileFrames[0], palette, options), gracon.getPaletteWriteStream(palette, options))
-
-    # collect some information about frames
-    maxTileLength = 0
-    maxPaletteLength = 0
-    framecount = len(tileFrames)
-    currentFramePointer = 0
-    framePointers = []
-
-    for frame in frames:
-        framePointers.append(currentFramePointer)
-        currentFramePointer += FRAME_HEADER_SIZE + \
-            len(frame[0]) + len(frame[1]) + len(frame[2])
-        maxTileLength = len(frame[0]) if maxTileLength < len(
-            frame[0]) else maxTileLength
-        maxPaletteLength = len(frame[2]) if maxPaletteLength < len(
-            frame[2]) else maxPaletteLength
 
-    try:
-        outFile = open(options.get('outfile'), 'wb')
-    except IOError:
-        logging.error('unable to access required output-file %s' %
-                      options.get('outfile'))
-        sys.exit(1)
+class TileUploads():
+    '''
+    keeps track of tiles in vram during sequential playback, so frames can reference tiles uploaded by preceding frames
+    instead of uploading them again. see -delta option for modes.
+    '''
 
-    # write header
+    def __init__(self, mode, maxSharedTiles):
+        self.mode = mode
+        self.maxSharedTiles = maxSharedTiles
+        # tile bytes -> tile id in vram
+        self.ids = {}
+        self.tiles = []
+        self.deltaFrames = 0
+        self.uploadBytes = 0
+        self.savedBytes = 0
+
+    def assign(self, tileFrame, tileStream):
+        '''
+        points out ids of actual tiles of frame at their copies in vram where possible.
+        returns tile bytes to be uploaded with frame, empty if frame gets by with tiles already in vram
+        '''
+        count = tileFrame.actualCount()
+        if self.mode == 'off' or not count:
+            self.uploadBytes += len(tileStream)
+            return tileStream
+
+        tileSize = len(tileStream) // count
+        chunks = [tileStream[start:start + tileSize] for start in range(0, len(tileStream), tileSize)]
+        if self.mode == 'shared':
+            # frame building up shared tileset from scratch is the one uploading it
+            self.deltaFrames += 1 if self.tiles else 0
+            for chunk in chunks:
+                if chunk not in self.ids:
+                    self.ids[chunk] = len(self.tiles)
+                    self.tiles.append(chunk)
+            if self.maxSharedTiles < len(self.tiles):
+                logging.error('Error, shared tileset exceeds maximum of %s tiles, use delta mode subset or off.' %
+                              self.maxSharedTiles)
+                sys.exit(1)
+        elif not self.ids or not all(chunk in self.ids for chunk in chunks):
+            # frame replaces tiles in vram
+            self.ids = {}
+            for tileId, chunk in enumerate(chunks):
+                self.ids.setdefault(chunk, tileId)
+            self.uploadBytes += len(tileStream)
+            return tileStream
+        else:
+            self.deltaFrames += 1
+        tileFrame.outId[tileFrame.refId == gracon.NO_REFERENCE] = [self.ids[chunk] for chunk in chunks]
+        self.savedBytes += len(tileStream)
+        return b''
+
+    def getSharedTiles(self):
+        '''tile bytes of shared tileset, uploaded with first frame'''
+        sharedTiles = b''.join(self.tiles)
+        if 0xffff < len(sharedTiles):
+            logging.error('Error, shared tileset of %s bytes exceeds frame tile size limit, use delta mode subset or off.' %
+                          len(sharedTiles))
+            sys.exit(1)
+        self.savedBytes -= len(sharedTiles)
+        self.uploadBytes += len(sharedTiles)
+        return sharedTiles
+
+
+def getBlockBytes(block):
+    if isinstance(block, str):
+        return block.encode('latin1')
+    elif isinstance(block, (bytes, bytearray)):
+        return block
+    elif isinstance(block, (list, tuple)) and all(isinstance(item, str) for item in block):
+        return ''.join(block).encode('latin1')
+    return bytes(block)
+
+
+def writeFrame(outFile, frame):
+    # write frame header
+    outFile.write(bytes((len(frame[0]) & 0xff,)))
+    outFile.write(bytes(((len(frame[0]) & 0xff00) >> 8,)))
+
+    outFile.write(bytes((len(frame[1]) & 0xff,)))
+    outFile.write(bytes(((len(frame[1]) & 0xff00) >> 8,)))
+
+    outFile.write(bytes((len(frame[2]) & 0xff,)))
+    outFile.write(bytes(((len(frame[2]) & 0xff00) >> 8,)))
+
+    # write tiles, tilemap, palette
+    for block in frame:
+        outFile.write(block)
+
+
+def writeHeader(outFile, maxTileLength, maxPaletteLength, framePointers, options):
+    '''writes header & pointer table in front of frames, pointers are absolute file offsets of frames'''
+    outFile.seek(0)
     outFile.write(HEADER_MAGIC)
 
     outFile.write(bytes((maxTileLength & 0xff,)))
@@ -224,6 +503,7 @@ def main():
     outFile.write(bytes((maxPaletteLength & 0xff,)))
     outFile.write(bytes(((maxPaletteLength & 0xff00) >> 8,)))
 
+    framecount = len(framePointers)
     outFile.write(bytes((framecount & 0xff,)))
     outFile.write(bytes(((framecount & 0xff00) >> 8,)))
 
@@ -232,36 +512,72 @@ def main():
     # write framepointerlist
     outFile.seek(HEADER_SIZE)
     for framePointer in framePointers:
-        framePointer += HEADER_SIZE + len(framePointers)*2
         outFile.write(bytes((framePointer & 0xff,)))
         outFile.write(bytes(((framePointer & 0xff00) >> 8,)))
 
-    # write frames
-    for frame in frames:
-        # write frame header
-        outFile.write(bytes((len(frame[0]) & 0xff,)))
-        outFile.write(bytes(((len(frame[0]) & 0xff00) >> 8,)))
-
-        outFile.write(bytes((len(frame[1]) & 0xff,)))
-        outFile.write(bytes(((len(frame[1]) & 0xff00) >> 8,)))
-
-        outFile.write(bytes((len(frame[2]) & 0xff,)))
-        outFile.write(bytes(((len(frame[2]) & 0xff00) >> 8,)))
-
-        # write tiles, tilemap, palette
-        for block in frame:
-            if isinstance(block, str):
-                block_bytes = block.encode('latin1')
-            elif isinstance(block, (bytes, bytearray)):
-                block_bytes = block
-            elif isinstance(block, (list, tuple)) and all(isinstance(item, str) for item in block):
-                block_bytes = ''.join(block).encode('latin1')
-            else:
-                block_bytes = bytes(block)
-            outFile.write(block_bytes)
 
-    logging.info('Successfully wrote animation file %s.' %
-                 options.get('outfile'))
+def mapFrames(pool, function, jobs, window):
+    '''
+    ordered, lazy map of function over jobs, in worker pool if present.
+    no more than window jobs are in flight, unlike Pool.imap, which queues all jobs and buffers any number of results.
+    '''
+    if not pool:
+        for job in jobs:
+            yield function(job)
+        return
+
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def parseFrame(job):
+    '''
+    loads, reduces and tiles single frame image, returns (TileSet, (resolutionx, resolutiony)) or None on failure.
+    run by worker processes
+    '''
+    options, fileName = job
+    try:
+        tiles = gracon.parseTiles(gracon.getInputImage(options, fileName), options)
+        return tiles, (options.get('resolutionx'), options.get('resolutiony'))
+    except SystemExit:
+        # gracon logs the error and exits, which would leave pool waiting for the result of a dead worker
+        return None
+
+
+def getFrameHistogram(job):
+    '''loads single frame image, returns its (colors, pixel counts) or None on failure. run by worker processes'''
+    frame = parseFrame(job)
+    return frame[0].getColorHistogram() if frame is not None else None
+
+
+def optimizeFrame(job):
+    '''
+    palettizes and optimizes tiles of parsed frame, returns (TileSet, (resolutionx, resolutiony)) or None on failure.
+    run by worker processes
+    '''
+    (tiles, resolution), palette, options = job
+    try:
+        return gracon.augmentOutIds(gracon.optimizeTiles(gracon.palettizeTiles(tiles, palette), options)), resolution
+    except SystemExit:
+        return None
+
+
+def setFrameResolution(options, resolution):
+    '''tilemaps are sized according to resolution of frame they belong to'''
+    options.set('resolutionx', resolution[0])
+    options.set('resolutiony', resolution[1])
+
+
+def getFrameResult(frame):
+    '''exits if frame could not be converted, cause has been logged by worker'''
+    if frame is None:
+        sys.exit(1)
+    return frame
 
 
 def debugLog(data, message=''):
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+'''
+golden output regression harness for the conversion tools.
+converts all graphics, animations, songs and msu1 audio of data/ plus deterministic synthetic cases with the
+makefile flags, then compares sha256 hashes of every output file against a recorded golden file.
+used to prove that rewrites of gracon, animationWriter, mod2snes and the msu1 writers keep output byte-identical.
+
+options:
+-golden       json file of recorded output hashes(default: tools/goldenoutputs.json)
+-record       on: write hashes of current outputs to -golden instead of comparing(default: off)
+-reference    folder to copy outputs to when recording. when comparing, changed files are diffed bytewise against it
+-extraflags   additional options appended to every gracon & animationWriter call, to check alternative code paths
+-only         comma separated list of case name prefixes to run(default: all)
+-jobs         cases converted in parallel, 0 uses all cores(default: 1)
+-workdir      folder for inputs & outputs, kept after run(default: temporary folder, removed after run)
+
+exit status is 1 if any tool fails or any output file is missing, unexpected or differs from the golden file.
+
+example, check that parallel quantizer keeps output identical:
+  python goldenoutputs.py -reference /tmp/golden -record on
+  python goldenoutputs.py -reference /tmp/golden -extraflags '-jobs 4'
+'''
+
+import os
+import sys
+import json
+import glob
+import shlex
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing.pool
+import wave
+import numpy as np
+import userOptions
+import toolbenchmark
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+TOOLS_DIR = toolbenchmark.TOOLS_DIR
+REPO_DIR = toolbenchmark.REPO_DIR
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+
+GOLDEN_VERSION = 1
+
+# mirror gfx_*_flags of makefile
+GRACON_FLAGS = dict(toolbenchmark.GRACON_FLAGS, **{
+    'font': '-verify off -optimize off -palettes 1 -bpp 2 -mode bg',
+    'font4bpp': '-verify off -optimize off -palettes 1 -bpp 4 -mode bg',
+    # makefile has no gfx_normal_flags, normal graphics use gracon defaults
+    'normal': '',
+})
+
+# number of differing byte ranges listed per changed file
+MAX_REPORTED_DIFFS = 4
+
+OPTION_DEFAULTS = {
+    'golden': {
+        'value': os.path.join(TOOLS_DIR, 'goldenoutputs.json'),
+        'type': 'str'
+    },
+    'record': {
+        'value': False,
+        'type': 'bool'
+    },
+    'reference': {
+        'value': '',
+        'type': 'str'
+    },
+    'extraflags': {
+        'value': '',
+        'type': 'str'
+    },
+    'only': {
+        'value': '',
+        'type': 'str'
+    },
+    'jobs': {
+        'value': 1,
+        'type': 'int',
+        'max': 255,
+        'min': 0
+    },
+    'workdir': {
+        'value': '',
+        'type': 'str'
+    },
+}
+
+
+def main():
+    if any(arg in sys.argv for arg in ['-h', '--help', '-help']):
+        print(__doc__)
+        sys.exit(0)
+
+    options = userOptions.Options(sys.argv, OPTION_DEFAULTS)
+    workdir = options.get('workdir') or tempfile.mkdtemp(prefix='goldenoutputs')
+    try:
+        cases = getCases(workdir, options)
+        if not cases:
+            logging.error('No cases match -only %s.' % options.get('only'))
+            sys.exit(1)
+        outputs = runCases(cases, workdir, options)
+
+        if options.get('record'):
+            if None in outputs.values():
+                logging.error('Not recording golden file, converters failed.')
+                sys.exit(1)
+            recordOutputs(outputs, workdir, options)
+            sys.exit(0)
+
+        sys.exit(0 if compareOutputs(outputs, readGolden(options.get('golden')), workdir, options) else 1)
+    finally:
+        if not options.get('workdir'):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def getCases(workdir, options):
+    '''
+    returns {name: [command]} of all conversion cases selected by -only.
+    commands write their outputs to workdir/outputs/<name>/, synthetic inputs are generated to workdir/inputs/.
+    '''
+    cases = {}
+    extraFlags = shlex.split(options.get('extraflags'))
+    selected = [prefix.strip() for prefix in options.get('only').split(',') if prefix.strip()]
+
+    def isSelected(name):
+        return not selected or any(name.startswith(prefix) for prefix in selected)
+
+    def addCase(name, tool, *args):
+        cases[name] = [toolbenchmark.getToolCommand(tool, *args)]
+
+    def graconCase(name, flags, infile):
+        name = 'gracon/%s' % name
+        if isSelected(name):
+            addCase(name, 'gracon.py', *flags.split(), *extraFlags, '-infile', infile,
+                    '-outfilebase', getOutputPath(workdir, name, 'out'))
+
+    def animationCase(name, flags, folder):
+        name = 'animationwriter/%s' % name
+        if isSelected(name):
+            addCase(name, 'animationWriter.py', *flags.split(), *extraFlags, '-infolder', folder,
+                    '-outfile', getOutputPath(workdir, name, 'out.animation'))
+
+    for gfxType in ('font', 'font4bpp', 'normal', 'video'):
+        for image in findData('*.gfx_%s.png' % gfxType):
+            graconCase(getDataName(image), GRACON_FLAGS[gfxType], image)
+    for gfxType, folders in (('bg', findData('*.gfx_bg')), ('directcolor', findData('*.gfx_directcolor')),
+                             ('sprite', findData('*.gfx_sprite'))):
+        for folder in folders:
+            animationCase(getDataName(folder), '-mode sprite' if gfxType == 'sprite' else GRACON_FLAGS[gfxType], folder)
+            for image in sorted(glob.glob(os.path.join(folder, '*.png'))):
+                graconCase(getDataName(image), GRACON_FLAGS[gfxType], image)
+    for song in findData('*.mod'):
+        name = 'mod2snes/%s' % getDataName(song)
+        if isSelected(name):
+            addCase(name, 'mod2snes.py', song, getOutputPath(workdir, name, 'out'))
+    for sound in findData('*.sfx_video.wav'):
+        name = 'msu1pcmwriter/%s' % getDataName(sound)
+        if isSelected(name):
+            addCase(name, 'msu1pcmwriter.py', '-infile', sound, '-outfile', getOutputPath(workdir, name, 'out.pcm'))
+
+    cases.update(getSyntheticCases(workdir, extraFlags, isSelected))
+    return cases
+
+
+def getSyntheticCases(workdir, extraFlags, isSelected):
+    '''returns {name: [command]} of cases converting deterministic synthetic inputs, generated only if selected'''
+    cases = {}
+    inputDir = os.path.join(workdir, 'inputs')
+    os.makedirs(inputDir, exist_ok=True)
+
+    # every case seeds its own inputs, so -only does not change them
+    for gfxType, getter, size, budgetFlags in (
+            ('bg', toolbenchmark.getSyntheticScene, (256, 224), ''),
+            ('directcolor', toolbenchmark.getSyntheticScene, (256, 224), ''),
+            ('sprite', toolbenchmark.getSyntheticSprite, (128, 64), ''),
+            ('video', toolbenchmark.getSyntheticVideoFrame, (256, 160), ''),
+            ('bg.large', toolbenchmark.getSyntheticScene, (512, 288), ''),
+            # maxtiles has to be met by raising tilethreshold from 0
+            ('bg.budget', toolbenchmark.getSyntheticScene, (128, 64), '-tilethreshold 0 -maxtiles 40')):
+        name = 'synthetic/gracon/%s' % gfxType
+        if not isSelected(name):
+            continue
+        images = toolbenchmark.writeSyntheticImages(inputDir, gfxType, 3, *size, getter)
+        flags = GRACON_FLAGS[gfxType.split('.')[0]].split() + budgetFlags.split()
+        cases[name] = [toolbenchmark.getToolCommand(
+            'gracon.py', *flags, *extraFlags, '-infile', image,
+            '-outfilebase', getOutputPath(workdir, name, os.path.splitext(os.path.basename(image))[0]))
+            for image in images]
+
+    # wide frames are parsed in worker processes, which must hand their resolution back for tilemap encoding
+    for gfxType, folderName, flags, getter, size in (
+            ('video', 'animation.gfx_bg', GRACON_FLAGS['video'], toolbenchmark.getSyntheticVideoFrame, (128, 96)),
+            ('bg.large', 'animation.large.gfx_bg', GRACON_FLAGS['bg'] + ' -jobs 2', toolbenchmark.getSyntheticScene, (512, 288))):
+        name = 'synthetic/animationwriter/%s' % gfxType
+        if not isSelected(name):
+            continue
+        folder = os.path.join(inputDir, folderName)
+        os.makedirs(folder, exist_ok=True)
+        toolbenchmark.writeSyntheticImages(folder, 'frame', 4 if gfxType == 'video' else 3, *size, getter)
+        cases[name] = [toolbenchmark.getToolCommand(
+            'animationWriter.py', *flags.split(), *extraFlags, '-infolder', folder,
+            '-outfile', getOutputPath(workdir, name, 'out.animation'))]
+
+    name = 'synthetic/mod2snes'
+    if isSelected(name):
+        module, _ = toolbenchmark.getSyntheticModule(np.random.RandomState(toolbenchmark.SEED))
+        moduleFileName = os.path.join(inputDir, 'synthetic.mod')
+        with open(moduleFileName, 'wb') as moduleFile:
+            moduleFile.write(module)
+        cases[name] = [toolbenchmark.getToolCommand('mod2snes.py', moduleFileName, getOutputPath(workdir, name, 'out'))]
+
+    name = 'synthetic/msu1pcmwriter'
+    if isSelected(name):
+        soundFileName = os.path.join(inputDir, 'synthetic.sfx_video.wav')
+        writeSyntheticWave(soundFileName, np.random.RandomState(toolbenchmark.SEED))
+        cases[name] = [toolbenchmark.getToolCommand(
+            'msu1pcmwriter.py', '-loopstart', '4410', '-infile', soundFileName,
+            '-outfile', getOutputPath(workdir, name, 'out.pcm'))]
+
+    name = 'synthetic/msu1blockwriter'
+    if isSelected(name):
+        chapterDir = os.path.join(inputDir, 'chapters')
+        toolbenchmark.writeSyntheticChapters(chapterDir, np.random.RandomState(toolbenchmark.SEED),
+                                             frameCount=4, audioSeconds=1)
+        cases[name] = [toolbenchmark.getToolCommand(
+            'msu1blockwriter.py', '-title', 'GOLDEN', '-infilebase', chapterDir,
+            '-outfile', getOutputPath(workdir, name, 'out.msu'))]
+    return cases
+
+
+def writeSyntheticWave(fileName, random, seconds=1):
+    '''writes 16bit stereo 44.1kHz wave file as accepted by msu1pcmwriter'''
+    outFile = wave.open(fileName, 'wb')
+    outFile.setnchannels(2)
+    outFile.setsampwidth(2)
+    outFile.setframerate(44100)
+    outFile.writeframes(random.randint(-0x8000, 0x8000, 44100 * 2 * seconds).astype('<i2').tobytes())
+    outFile.close()
+
+
+def findData(pattern):
+    return sorted(glob.glob(os.path.join(DATA_DIR, '**', pattern), recursive=True))
+
+
+def getDataName(path):
+    return os.path.relpath(path, DATA_DIR)
+
+
+def getOutputPath(workdir, name, fileName):
+    '''returns path of output file of case, creating the case output folder'''
+    folder = os.path.join(workdir, 'outputs', name)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, fileName)
+
+
+def runCases(cases, workdir, options):
+    '''runs all cases, returns {name: {relative file name: (sha256, size)}}, None for cases whose converter failed'''
+    jobs = [(name, commands, os.path.join(workdir, 'outputs', name)) for name, commands in sorted(cases.items())]
+    processCount = min(options.get('jobs') or os.cpu_count() or 1, len(jobs))
+    if processCount > 1:
+        # converters run in their own processes, threads only wait for them
+        pool = multiprocessing.pool.ThreadPool(processCount)
+        results = pool.imap(runCase, jobs)
+    else:
+        pool = None
+        results = (runCase(job) for job in jobs)
+
+    outputs = {}
+    try:
+        for name, hashes in results:
+            outputs[name] = hashes
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return outputs
+
+
+def runCase(job):
+    name, commands, outputDir = job
+    for command in commands:
+        result = subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode:
+            logging.error('%s: converter failed with exit status %s: %s\n%s' % (
+                name, result.returncode, ' '.join(command), result.stdout.decode('utf-8', 'replace')))
+            return name, None
+    return name, hashOutputs(outputDir)
+
+
+def hashOutputs(outputDir):
+    '''returns {relative file name: (sha256, size)} of all files in output folder of case'''
+    hashes = {}
+    for root, dirs, names in os.walk(outputDir):
+        for fileName in names:
+            path = os.path.join(root, fileName)
+            with open(path, 'rb') as outputFile:
+                data = outputFile.read()
+            hashes[os.path.relpath(path, outputDir).replace(os.sep, '/')] = (hashlib.sha256(data).hexdigest(), len(data))
+    return hashes
+
+
+def recordOutputs(outputs, workdir, options):
+    golden = {name: {fileName: {'sha256': digest, 'size': size} for fileName, (digest, size) in sorted(hashes.items())}
+              for name, hashes in outputs.items()}
+    if options.get('only'):
+        # partial record keeps cases that were not run
+        golden = dict(readGolden(options.get('golden')), **golden)
+    with open(options.get('golden'), 'w') as goldenFile:
+        json.dump({'version': GOLDEN_VERSION, 'cases': golden}, goldenFile, indent=1, sort_keys=True)
+        goldenFile.write('\n')
+
+    if options.get('reference'):
+        for name in outputs:
+            reference = os.path.join(options.get('reference'), name)
+            shutil.rmtree(reference, ignore_errors=True)
+            shutil.copytree(os.path.join(workdir, 'outputs', name), reference)
+    logging.info('Recorded %s output files of %s cases to %s.' % (
+        sum([len(hashes) for hashes in outputs.values()]), len(outputs), options.get('golden')))
+
+
+def readGolden(fileName):
+    try:
+        with open(fileName) as goldenFile:
+            golden = json.load(goldenFile)
+    except (OSError, ValueError):
+        logging.error('Unable to read golden file %s, record one with -record on first.' % fileName)
+        sys.exit(1)
+    if golden.get('version') != GOLDEN_VERSION:
+        logging.error('Golden file %s has incompatible version %s.' % (fileName, golden.get('version')))
+        sys.exit(1)
+    return golden['cases']
+
+
+def compareOutputs(outputs, golden, workdir, options):
+    '''logs every output file differing from golden file, returns True if all outputs are identical'''
+    failed = []
+    fileCount = 0
+    for name, hashes in sorted(outputs.items()):
+        if name not in golden:
+            logging.error('%s: no golden hashes recorded for case.' % name)
+            failed.append(name)
+            continue
+        if hashes is None:
+            failed.append(name)
+            continue
+        expected = golden[name]
+        differences = ['%s: missing' % fileName for fileName in sorted(set(expected) - set(hashes))]
+        differences += ['%s: unexpected output file' % fileName for fileName in sorted(set(hashes) - set(expected))]
+        for fileName in sorted(set(hashes) & set(expected)):
+            fileCount += 1
+            digest, size = hashes[fileName]
+            if digest != expected[fileName]['sha256']:
+                differences.append('%s: %s' % (fileName, getFileDiff(
+                    os.path.join(workdir, 'outputs', name, fileName), expected[fileName]['size'],
+                    os.path.join(options.get('reference'), name, fileName) if options.get('reference') else None)))
+        if differences:
+            logging.error('%s differs from golden output:\n  %s' % (name, '\n  '.join(differences)))
+            failed.append(name)
+
+    logging.info('Compared %s output files of %s cases, %s cases differ.' % (fileCount, len(outputs), len(failed)))
+    return not failed
+
+
+def getFileDiff(fileName, expectedSize, referenceFileName):
+    '''describes change of output file, bytewise if reference copy of golden output is available'''
+    with open(fileName, 'rb') as outputFile:
+        data = np.frombuffer(outputFile.read(), dtype=np.uint8)
+    message = 'hash differs, size %s -> %s' % (expectedSize, len(data))
+    if not referenceFileName or not os.path.exists(referenceFileName):
+        return message
+
+    with open(referenceFileName, 'rb') as referenceFile:
+        reference = np.frombuffer(referenceFile.read(), dtype=np.uint8)
+    common = min(len(data), len(reference))
+    offsets = np.flatnonzero(data[:common] != reference[:common])
+    if not len(offsets):
+        return '%s, identical up to offset 0x%x' % (message, common)
+    # group differing offsets into contiguous ranges
+    starts = offsets[np.r_[True, np.diff(offsets) > 1]]
+    ends = offsets[np.r_[np.diff(offsets) > 1, True]]
+    ranges = ', '.join(['0x%x-0x%x' % (start, end) for start, end in zip(starts[:MAX_REPORTED_DIFFS], ends)])
+    return '%s, %s bytes differ in %s ranges: %s%s' % (
+        message, len(offsets), len(starts), ranges, ', ...' if len(starts) > MAX_REPORTED_DIFFS else '')
+
+
+if __name__ == "__main__":
+    main()
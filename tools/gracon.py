@@ -1,34 +1,25 @@
 #!/usr/bin/env python3
 
 import userOptions
-from PIL import ImageFont
-from PIL import ImageDraw
-from PIL import Image
+# numpy stays at module level, color lookup tables and constants below are built from it at import
+import numpy as np
 import logging
 import time
 import math
 import sys
 import os
-from functools import cmp_to_key
+import io
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
 __author__ = "Matthias Nagler <matt@dforce.de>"
 __url__ = ("dforce3000", "dforce3000.de")
 __version__ = "0.1"
 
-'''
-optimizations:
--flatten tile dict
-  tile['data']
-  
--flatten pixel arrays
-  tile['data']['pixel']
-  tile['data']['indexedPixel']
-  
-
-'''
-
 '''
 todo:
--check if images spanning multiple tilemaps have their tilemaps selected properly. probably not.
 -have usage string if no parameter supplied or if parameter of unknown type found
 '''
 
@@ -64,6 +55,7 @@ target format sprite tilemap:
 format bg tilemap:
   byte    0            1
           cccccccc    vhopppcc
+  images exceeding 32x32 tiles are split into 32x32 tile tilemaps, written left to right, then top to bottom.
           
 directcolor mode:
 
@@ -87,10 +79,169 @@ INFINITY = 1e300000
 BG_TILEMAP_SIZE = 32
 LOOKBACK_TILES = 128
 EMPTY_COLOR = 0
+NO_REFERENCE = -1
+NO_DISTANCE = np.iinfo(np.int64).max
+
+MIRROR_NONE = 0
+MIRROR_X = 1
+MIRROR_Y = 2
+MIRROR_XY = 3
+# lower bound of per-channel weights in tile error formula, red >= 512/256, green = 4, blue >= (767-31)/256
+MIN_COLOR_ERROR_WEIGHTS = np.array((2.0, 4.0, 2.875))
+# smallest square error two non-identical tiles can have(red channel differing by 1)
+MIN_TILE_SQUARE_ERROR = 2.0
+# tilethreshold increment when exceeding maxtiles
+TILE_THRESHOLD_STEP = 3
+# upper bound of error between two pixels, maximum red, green, blue difference
+MAX_COLOR_ERROR = math.sqrt(((512+31) * 31 * 31) / 256 + 4 * 31 * 31 + (767 * 31 * 31) / 256)
+# slack for float32 rounding of tile errors when pruning by lower bound
+TILE_ERROR_TOLERANCE = 1e-3
+
+
+OPTION_DEFAULTS = {
+    'bpp': {
+        'value': 4,
+        'type': 'int',
+        'max': 8,
+        'min': 1
+    },
+    'palettes': {
+        'value': 1,
+        'type': 'int',
+        'max': 8,
+        'min': 1
+    },
+    'mode': {
+        'value': 'bg',
+        'type': 'str'
+    },
+    'optimize': {
+        'value': True,
+        'type': 'bool'
+    },
+    'directcolor': {
+        'value': False,
+        'type': 'bool'
+    },
+    'transcol': {
+        'value': 0x7c1f,
+        'type': 'hex',
+        'max': 0x7fff,
+        'min': 0x0
+    },
+    'tilethreshold': {
+        'value': 1,
+        'type': 'int',
+        'max': 0xffff,
+        'min': 0
+    },
+    'verify': {
+        'value': False,
+        'type': 'bool'
+    },
+    'tilesizex': {
+        'value': 8,
+        'type': 'int',
+        'max': 16,
+        'min': 8
+    },
+    'tilesizey': {
+        'value': 8,
+        'type': 'int',
+        'max': 16,
+        'min': 8
+    },
+    'maxtiles': {
+        'value': 0x3ff,
+        'type': 'int',
+        'max': 0x3ff,
+        'min': 0
+    },
+    'refpalette': {
+        'value': '',
+        'type': 'str'
+    },
+    'quantizer': {
+        'value': 'adaptive',
+        'type': 'str'
+    },
+    'infile': {
+        'value': '',
+        'type': 'str'
+    },
+    'outfilebase': {
+        'value': '',
+        'type': 'str'
+    },
+    'resolutionx': {
+        'value': 256,
+        'type': 'int',
+        'max': 0xffff,
+        'min': 1
+    },
+    'resolutiony': {
+        'value': 224,
+        'type': 'int',
+        'max': 0xffff,
+        'min': 1
+    },
+    'manifest': {
+        'value': '',
+        'type': 'str'
+    },
+    'batch': {
+        'value': '',
+        'type': 'str'
+    },
+    'jobs': {
+        'value': 1,
+        'type': 'int',
+        'max': 0xff,
+        'min': 0
+    },
+    'psnr': {
+        'value': False,
+        'type': 'bool'
+    },
+    'profile': {
+        'value': '',
+        'type': 'str'
+    },
+    'cprofile': {
+        'value': False,
+        'type': 'bool'
+    },
+    'tracemalloc': {
+        'value': False,
+        'type': 'bool'
+    },
+    'cache': {
+        'value': '',
+        'type': 'str'
+    },
+    'cachesize': {
+        'value': 256,
+        'type': 'int',
+        'max': 0xffff,
+        'min': 1
+    },
+}
+
+# options that select batch jobs instead of being handed down to each job
+BATCH_OPTIONS = ('manifest', 'batch', 'jobs')
+
+# options affecting conversion output. refpalette is hashed by image content instead of filename
+CACHE_KEY_OPTIONS = ('bpp', 'palettes', 'mode', 'optimize', 'directcolor', 'transcol', 'tilethreshold',
+                     'verify', 'psnr', 'tilesizex', 'tilesizey', 'maxtiles', 'quantizer')
+
+# bump whenever output of identical input & options changes, invalidates all cached conversions
+CACHE_VERSION = 4
 
 
 def print_usage():
     print("Usage: gracon.py -infile <filename> [options]")
+    print("       gracon.py -manifest <filename> [options]")
+    print("       gracon.py -batch <glob> [options]")
     print("\nOptions:")
     print("  -outfilebase <base>   Output filename base (default: infile base)")
     print("  -bpp <1/2/4/8>        Bits per pixel (default: 4)")
@@ -98,8 +249,21 @@ def print_usage():
     print("  -mode <bg/sprite>     Mode (default: bg)")
     print("  -optimize <on/off>    Optimize tiles (default: on)")
     print("  -verify <on/off>      Verify output (default: off)")
+    print("  -psnr <on/off>        Log PSNR of decoded output against input image (default: off)")
     print("  -transcol <hex>       Transparent color (default: 0x7C1F)")
     print("  -tilethreshold <int>  Tile optimization threshold (default: 1)")
+    print("  -quantizer <adaptive/mediancut/kmeans>")
+    print("                        Color reduction, mediancut & kmeans work on 15bit snes colors (default: adaptive)")
+    print("  -manifest <file>      Convert all jobs listed in file, one line of gracon options per image.")
+    print("                        Options on the command line apply to every job unless overridden.")
+    print("  -batch <glob>         Convert all images matching glob with options on the command line.")
+    print("                        -outfilebase is used as output folder, mirroring input paths.")
+    print("  -jobs <0-255>         Worker processes for -manifest/-batch, 0 uses all cores (default: 1)")
+    print("  -profile <file>       Append duration, memory & counters of each conversion stage as json lines")
+    print("  -cprofile <on/off>    Write cProfile stats of conversion to <outfilebase>.prof (default: off)")
+    print("  -tracemalloc <on/off> Record peak memory per stage with tracemalloc, slows conversion (default: off)")
+    print("  -cache <folder>       Reuse output of previous conversions with identical pixels and options (default: off)")
+    print("  -cachesize <MB>       Evict least recently used cache entries beyond this size (default: 256)")
     print("\nExample:")
     print("  python gracon.py -infile myimage.png -mode bg -bpp 4 -verify on")
 
@@ -108,128 +272,87 @@ def main():
         print_usage()
         sys.exit(0)
 
-    options = userOptions.Options(sys.argv, {
-        'bpp': {
-            'value': 4,
-            'type': 'int',
-            'max': 8,
-            'min': 1
-        },
-        'palettes': {
-            'value': 1,
-            'type': 'int',
-            'max': 8,
-            'min': 1
-        },
-        'mode': {
-            'value': 'bg',
-            'type': 'str'
-        },
-        'optimize': {
-            'value': True,
-            'type': 'bool'
-        },
-        'directcolor': {
-            'value': False,
-            'type': 'bool'
-        },
-        'transcol': {
-            'value': 0x7c1f,
-            'type': 'hex',
-            'max': 0x7fff,
-            'min': 0x0
-        },
-        'tilethreshold': {
-            'value': 1,
-            'type': 'int',
-            'max': 0xffff,
-            'min': 0
-        },
-        'verify': {
-            'value': False,
-            'type': 'bool'
-        },
-        'tilesizex': {
-            'value': 8,
-            'type': 'int',
-            'max': 16,
-            'min': 8
-        },
-        'tilesizey': {
-            'value': 8,
-            'type': 'int',
-            'max': 16,
-            'min': 8
-        },
-        'maxtiles': {
-            'value': 0x3ff,
-            'type': 'int',
-            'max': 0x3ff,
-            'min': 0
-        },
-        'refpalette': {
-            'value': '',
-            'type': 'str'
-        },
-        'infile': {
-            'value': '',
-            'type': 'str'
-        },
-        'outfilebase': {
-            'value': '',
-            'type': 'str'
-        },
-        'resolutionx': {
-            'value': 256,
-            'type': 'int',
-            'max': 0xffff,
-            'min': 1
-        },
-        'resolutiony': {
-            'value': 224,
-            'type': 'int',
-            'max': 0xffff,
-            'min': 1
-        },
-    })
-    t0 = time.perf_counter()
+    options = userOptions.Options(sys.argv, OPTION_DEFAULTS)
 
-    if options.get('directcolor'):
-        options.set('bpp', 8)
-        options.set('palettes', 1)
-
-    if not options.get('outfilebase'):
-        options.set('outfilebase', options.get('infile'))
+    if options.get('manifest') or options.get('batch'):
+        sys.exit(0 if convertBatch(options, sys.argv) else 1)
 
     if not options.get('infile'):
         print_usage()
         sys.exit(1)
 
-    inputImage = getInputImage(options, options.get('infile'))
-    logging.info(f"Input image loaded and reduced in {time.perf_counter() - t0:.2f}s")
-    
-    t1 = time.perf_counter()
-    tiles = parseTiles(inputImage, options)
-    logging.info(f"Tiles parsed in {time.perf_counter() - t1:.2f}s")
+    convertImage(options)
+
+
+def convertImage(options):
+    '''runs whole conversion pipeline for a single image and writes output files, returns Statistics'''
+    streams, stats = encodeImage(options)
+
+    profiler = StageProfiler(options.get('infile'))
+    with profiler.stage('write', 'Output files written'):
+        writeOutputStreams(streams, options)
+    stats.stages += profiler.records
+
+    logConversionStatistics(stats)
+    writeProfileRecords(stats.stages, options)
+    if options.get('cache'):
+        logCacheStatistics([stats], options)
+    return stats
 
-    t2 = time.perf_counter()
-    optimizedPalette = parseGlobalPalettes(tiles, options)
-    logging.info(f"Global palettes parsed in {time.perf_counter() - t2:.2f}s")
 
-    t3 = time.perf_counter()
-    palettizedTiles = palettizeTiles(tiles, optimizedPalette)
-    logging.info(f"Tiles palettized in {time.perf_counter() - t3:.2f}s")
+def encodeImage(options):
+    '''runs whole conversion pipeline for a single image, returns ({extension: bytes}, Statistics)'''
+    applyImplicitOptions(options)
+    profiler = StageProfiler(options.get('infile'))
+    hooks = startProfilingHooks(options)
+    try:
+        streams, stats = encodeProfiledImage(options, profiler)
+    finally:
+        stopProfilingHooks(hooks, '%s.prof' % options.get('outfilebase'))
+    stats.stages = profiler.records
+    return streams, stats
+
 
-    # stupid hack that ensures certain amount of tiles are never exceeded for any given picture
+def encodeProfiledImage(options, profiler):
+    t0 = time.perf_counter()
+    with profiler.stage('load') as record:
+        sourceImage = loadImage(options.get('infile'))
+        cache = ConversionCache(options.get('cache'), options.get('cachesize')) if options.get('cache') else None
+        cached = None
+        if cache:
+            cacheKey = cache.getKey(sourceImage, options)
+            cached = cache.load(cacheKey)
+            record['cached'] = bool(cached)
+    if cached:
+        streams, stats = cached
+        stats.cached = True
+        stats.timeWasted = time.perf_counter() - t0
+        logging.info('Output streams of %s loaded from cache.' % options.get('infile'))
+        return streams, stats
+
+    with profiler.stage('reduce', 'Input image loaded and reduced') as record:
+        inputImage = prepareInputImage(sourceImage, options)
+        record['resolution'] = [inputImage['resolutionX'], inputImage['resolutionY']]
+
+    with profiler.stage('parse', 'Tiles parsed') as record:
+        tiles = parseTiles(inputImage, options)
+        record['tiles'] = len(tiles)
+
+    with profiler.stage('palette', 'Global palettes parsed') as record:
+        optimizedPalette = parseGlobalPalettes(tiles, options)
+        record['palettes'] = len(optimizedPalette)
+
+    with profiler.stage('palettize', 'Tiles palettized'):
+        palettizedTiles = palettizeTiles(tiles, optimizedPalette)
+
+    # ensures certain amount of tiles are never exceeded for any given picture
     if options.get('optimize'):
-        t4 = time.perf_counter()
-        optimizedTiles = optimizeTiles(palettizedTiles, options)
-        logging.info(f"Tiles optimized in {time.perf_counter() - t4:.2f}s")
-        while len([tile for tile in optimizedTiles if tile['refId'] == None]) > options.get('maxtiles'):
-            options.set('tilethreshold', options.get('tilethreshold') + 3)
-            logging.info('maxtiles %s exceed, running again with threshold %s.' % (
-                options.get('maxtiles'), options.get('tilethreshold')))
-            optimizedTiles = optimizeTiles(palettizedTiles, options)
+        with profiler.stage('optimize', 'Tiles optimized') as record:
+            threshold = options.get('tilethreshold')
+            optimizedTiles = optimizeTilesWithinBudget(palettizedTiles, options)
+            record['tiles'] = optimizedTiles.actualCount()
+            record['threshold'] = options.get('tilethreshold')
+            record['thresholdRetries'] = (options.get('tilethreshold') - threshold) // TILE_THRESHOLD_STEP
     else:
         optimizedTiles = palettizedTiles
 
@@ -237,23 +360,205 @@ def main():
 
     # debugLogTileStatus(optimizedTiles)
 
-    t5 = time.perf_counter()
-    writeOutputFiles(optimizedTiles, optimizedPalette, inputImage, options)
-    logging.info(f"Output files written in {time.perf_counter() - t5:.2f}s")
+    with profiler.stage('encode', 'Output streams encoded') as record:
+        streams = getOutputStreams(optimizedTiles, optimizedPalette, options)
+        record['bytes'] = sum([len(stream) for stream in streams.values()])
 
     stats = Statistics(optimizedTiles, optimizedPalette, t0)
+    if options.get('verify') or options.get('psnr'):
+        with profiler.stage('verify', 'Output verified') as record:
+            if options.get('verify'):
+                streams.update(getSampleStreams(streams, inputImage, options))
+            if options.get('psnr'):
+                stats.psnr = record['psnr'] = getPsnr(convertColorsSnesToRGB(renderOutputStreams(streams, inputImage, options)), sourceImage)
+    if cache:
+        cache.store(cacheKey, streams, stats)
+    return streams, stats
+
+
+def startProfilingHooks(options):
+    '''starts opt-in cProfile & tracemalloc, returns state required to stop them'''
+    hooks = {'profile': None, 'tracemalloc': False}
+    if options.get('cprofile'):
+        import cProfile
+        hooks['profile'] = cProfile.Profile()
+        hooks['profile'].enable()
+    if options.get('tracemalloc'):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            hooks['tracemalloc'] = True
+    return hooks
+
+
+def stopProfilingHooks(hooks, profileFileName):
+    '''stops hooks started by startProfilingHooks, cProfile stats are written to profileFileName'''
+    if hooks['tracemalloc']:
+        import tracemalloc
+        tracemalloc.stop()
+    if hooks['profile']:
+        hooks['profile'].disable()
+        try:
+            hooks['profile'].dump_stats(profileFileName)
+        except IOError:
+            logging.warning('unable to write profile %s' % profileFileName)
+
+
+def writeProfileRecords(records, options):
+    '''appends stage records to -profile file, one json object per line'''
+    if not options.get('profile'):
+        return
+    import json
+    try:
+        with open(options.get('profile'), 'a') as profileFile:
+            for record in records:
+                profileFile.write(json.dumps(record) + '\n')
+    except IOError:
+        logging.warning('unable to access profile file %s' % options.get('profile'))
+
+
+def applyImplicitOptions(options):
+    '''options implied by other options'''
+    if options.get('directcolor'):
+        options.set('bpp', 8)
+        options.set('palettes', 1)
+
+    if not options.get('outfilebase'):
+        options.set('outfilebase', options.get('infile'))
+
+
+def logConversionStatistics(stats):
     logging.info('conversion complete, optimized from %s to %s tiles, %s palettes used. Wasted %s seconds' % (
         stats.totalTiles, stats.actualTiles, stats.actualPalettes, stats.timeWasted))
+    if stats.psnr is not None:
+        logging.info('PSNR against input image: %.2f dB' % stats.psnr)
+
+
+def logCacheStatistics(jobStats, options):
+    '''reports cache hits & misses of finished conversions, evicts least recently used cache entries'''
+    hits = len([stats for stats in jobStats if stats.cached])
+    evicted = ConversionCache(options.get('cache'), options.get('cachesize')).evict()
+    logging.info('cache: %s hits, %s misses, %s entries evicted.' % (hits, len(jobStats) - hits, evicted))
+
+
+def convertBatch(options, args):
+    '''
+    converts all jobs of manifest or batch glob, returns False if any job failed.
+    with -jobs other than 1, jobs are encoded by a pool of worker processes.
+    output files are written by this process in job order either way.
+    '''
+    t0 = time.perf_counter()
+    jobs = [[args[0]] + jobArgs for jobArgs in getBatchJobs(options, args)]
+    processCount = min(options.get('jobs') or os.cpu_count() or 1, len(jobs))
+    failedJobs = []
+    jobStats = []
+
+    if processCount > 1:
+        logging.info('converting %s images with %s processes.' % (len(jobs), processCount))
+        import multiprocessing
+        pool = multiprocessing.Pool(processCount)
+        results = pool.imap(encodeBatchJob, jobs)
+    else:
+        pool = None
+        results = (encodeBatchJob(jobArgs) for jobArgs in jobs)
+
+    try:
+        for jobId, (jobArgs, (jobOptions, streams, stats)) in enumerate(zip(jobs, results)):
+            if streams is None or not writeBatchJob(jobOptions, streams, stats):
+                logging.error('job %s of %s failed.' % (jobId + 1, len(jobs)))
+                failedJobs.append(jobArgs[1:])
+                continue
+            logging.info('job %s of %s converted: %s' % (jobId + 1, len(jobs), ' '.join(jobArgs[1:])))
+            logConversionStatistics(stats)
+            writeProfileRecords(stats.stages, jobOptions)
+            jobStats.append(stats)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    logging.info('batch complete, converted %s of %s images in %.2f seconds.' % (
+        len(jobs) - len(failedJobs), len(jobs), time.perf_counter() - t0))
+    for jobArgs in failedJobs:
+        logging.error('failed job: %s' % ' '.join(jobArgs))
+    if options.get('cache'):
+        logCacheStatistics(jobStats, options)
+    return not failedJobs
+
+
+def encodeBatchJob(args):
+    '''
+    converts single batch job without writing any files, returns (Options, {extension: bytes}, Statistics).
+    safe to run in worker processes, failures return (None, None, None) instead of exiting.
+    '''
+    try:
+        jobOptions = userOptions.Options(args, OPTION_DEFAULTS)
+        streams, stats = encodeImage(jobOptions)
+        return jobOptions, streams, stats
+    except SystemExit:
+        # conversion stages report errors themselves before exiting
+        pass
+    except Exception:
+        logging.exception('conversion of %s failed.' % ' '.join(args[1:]))
+    return None, None, None
+
+
+def writeBatchJob(options, streams, stats):
+    '''writes output files of single batch job, returns False on failure'''
+    profiler = StageProfiler(options.get('infile'))
+    try:
+        with profiler.stage('write'):
+            if os.path.dirname(options.get('outfilebase')):
+                os.makedirs(os.path.dirname(options.get('outfilebase')), exist_ok=True)
+            writeOutputStreams(streams, options)
+        stats.stages += profiler.records
+    except SystemExit:
+        return False
+    except OSError:
+        logging.exception('unable to write output files of %s.' % options.get('outfilebase'))
+        return False
+    return True
+
+
+def getBatchJobs(options, args):
+    '''returns argument list of each job, command line arguments come first so jobs can override them'''
+    baseArgs = []
+    skipNext = False
+    for arg in args[1:]:
+        if skipNext:
+            skipNext = False
+        elif arg.startswith('-') and arg[1:] in BATCH_OPTIONS:
+            skipNext = True
+        else:
+            baseArgs.append(arg)
+
+    import glob
+    import shlex
+    jobs = []
+    if options.get('manifest'):
+        try:
+            manifest = open(options.get('manifest'), 'r')
+        except IOError:
+            logging.error('Unable to load manifest "%s"' % options.get('manifest'))
+            sys.exit(1)
+        with manifest:
+            jobs += [baseArgs + shlex.split(line) for line in manifest if line.strip() and not line.lstrip().startswith('#')]
+
+    if options.get('batch'):
+        for infile in sorted(glob.glob(options.get('batch'), recursive=True)):
+            outfilebase = os.path.join(options.get('outfilebase'), os.path.splitext(infile)[0]) if options.get('outfilebase') else infile
+            jobs.append(baseArgs + ['-infile', infile, '-outfilebase', outfilebase])
+    return jobs
 
 
 def debugLogTileStatus(tiles):
-    for tile in tiles:
+    for tileId in range(len(tiles)):
         debugLog({
-            'id': tile['id'],
-            'refId': tile['refId'],
-            'xMirror': tile['xMirror'],
-            'yMirror': tile['yMirror'],
-        }, 'tile %s' % tile['id'])
+            'id': tileId,
+            'refId': int(tiles.refId[tileId]),
+            'xMirror': bool(tiles.xMirror[tileId]),
+            'yMirror': bool(tiles.yMirror[tileId]),
+        }, 'tile %s' % tileId)
 
 
 def getReferencePaletteImage(options):
@@ -261,34 +566,56 @@ def getReferencePaletteImage(options):
 
 
 def writeOutputFiles(tiles, palettes, image, options):
+    streams = getOutputStreams(tiles, palettes, options)
+    if options.get('verify'):
+        streams.update(getSampleStreams(streams, image, options))
+    writeOutputStreams(streams, options)
+
+
+def getOutputStreams(tiles, palettes, options):
+    '''returns contents of all output files as {extension: bytes}'''
     outTiles = augmentOutIds(tiles)
     outPalettes = augmentOutIds(palettes)
+    streams = {}
 
-    # writeTiles( outTiles, options )
-    tileFile = getOutputFile(options, ext='tiles')
-    tileFile.write(getTileWriteStream(outTiles, options))
-    tileFile.close()
+    streams['tiles'] = getTileWriteStream(outTiles, options)
 
     if not options.get('directcolor'):
-        # writePalettes( outPalettes, options )
-        palFile = getOutputFile(options, ext='palette')
-        palFile.write(getPaletteWriteStream(outPalettes, options))
-        palFile.close()
-        if options.get('verify'):
-            writeSamplePalette(outPalettes, options)
-
-    # writeTileMap( outTiles, outPalettes, options )
-    tilemapFile = getOutputFile(options, ext='tilemap')
-    tilemapStream = getSpriteTileMapStream(tiles, palettes, options) if options.get(
+        streams['palette'] = getPaletteWriteStream(outPalettes, options)
+
+    streams['tilemap'] = getSpriteTileMapStream(tiles, palettes, options) if options.get(
         'mode') == 'sprite' else getBgTileMapStream(tiles, palettes, options)
-    tilemapFile.write(tilemapStream)
-    tilemapFile.close()
+    return streams
+
+
+def getSampleStreams(streams, image, options):
+    '''returns verify sample images decoded from output streams as {extension: png bytes}'''
+    samples = {}
+    if not options.get('directcolor'):
+        samples['sample_palette.png'] = getPngStream(getSamplePalette(streams, options))
+    samples['sample.png'] = getPngStream(getSampleImage(streams, image, options))
+    return samples
+
+
+def writeOutputStreams(streams, options):
+    for ext, stream in streams.items():
+        outFile = getOutputFile(options, ext)
+        outFile.write(stream)
+        outFile.close()
 
-    if options.get('verify'):
-        writeSampleImage(outTiles, outPalettes, image, options)
+
+def getPngStream(image):
+    stream = io.BytesIO()
+    image.save(stream, 'PNG')
+    return stream.getvalue()
 
 
 def augmentOutIds(elements):
+    if isinstance(elements, TileSet):
+        actual = elements.refId == NO_REFERENCE
+        elements.outId = np.where(actual, np.cumsum(actual) - 1, NO_REFERENCE).astype(np.int32)
+        return elements
+
     outElements = []
     outId = 0
     for element in elements:
@@ -302,196 +629,177 @@ def augmentOutIds(elements):
     return outElements
 
 
-def writeSamplePalette(palettes, options):
-    '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-    realPalettes = [pal for pal in palettes if pal['refId'] == None]
-    sample = Image.new("RGB", (2 ** options.get('bpp'), len(realPalettes)),
-                       convertColorSnesToRGB(options.get('transcol')))
-    for yPos in range(len(realPalettes)):
-        for xPos in range(2 ** options.get('bpp')):
-            try:
-                color = realPalettes[yPos]['color'][xPos]
-            except IndexError:
-                color = EMPTY_COLOR
-            sample.putpixel((xPos, yPos), convertColorSnesToRGB(color))
-    outFileName = "%s.%s" % (options.get('outfilebase'), 'sample_palette.png')
-    sample.save(outFileName, 'PNG')
-
-
-def writeSampleImage(tiles, palettes, image, options):
-    '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-    sample = Image.new("RGB", (image['resolutionX'], image['resolutionY']),
-                       convertColorSnesToRGB(options.get('transcol')))
-    for tile in tiles:
-        tileConfig = fetchTileConfig(tile, tiles, palettes)
-        if not options.get('directcolor'):
-            # hack, copy pixels of referenced tile into current tile
-            tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel']
-
-        actualTile = mirrorTile(
-            tile, {'x': tileConfig['xMirror'], 'y': tileConfig['yMirror']})
-        actualPalette = palettes[tileConfig['palId']]
-        for yPos in range(len(actualTile['pixel'])):
-            for xPos in range(len(actualTile['pixel'][yPos])):
-                if options.get('directcolor'):
-                    # source: -bbbbbgg gggrrrrr target: -bb---gg g--rrr--
-                    pixel = actualTile['pixel'][yPos][xPos] & 0x639c
-                else:
-                    colorIndex = actualTile['pixel'][yPos][xPos]
-                    try:
-                        pixel = actualPalette['color'][colorIndex]
-                    except IndexError:
-                        debugLog(actualPalette,
-                                 'bad palette index %s requested' % colorIndex)
-                        pixel = EMPTY_COLOR
-                pixelColor = convertColorSnesToRGB(pixel)
-                pixelPos = (actualTile['x']+xPos, actualTile['y']+yPos)
-                try:
-                    sample.putpixel(pixelPos, pixelColor)
-                except IndexError:
-                    debugLog(pixelPos, 'bad pixel position')
-    outFileName = "%s.%s" % (options.get('outfilebase'), 'sample.png')
-    # logging.debug("wrote sample image '%s'." % outFileName)
-    sample.save(outFileName, 'PNG')
+def getSamplePalette(streams, options):
+    '''used to provide output sample w/o having to load the created files in an SNES program, one palette per row'''
+    from PIL import Image
+    width = 2 ** options.get('bpp')
+    colorCount = options.get('bpp') ** 2
+    palettes = np.frombuffer(streams['palette'], dtype='<u2')
+    palettes = palettes[:len(palettes) - len(palettes) % colorCount].reshape(-1, colorCount)[:, :width]
+    sample = np.full((len(palettes), width), EMPTY_COLOR, dtype=np.uint16)
+    sample[:, :palettes.shape[1]] = palettes
+    return Image.fromarray(convertColorsSnesToRGB(sample), 'RGB')
 
 
-def parseTiles(image, options):
-    return parseSpriteTiles(image, options) if options.get('mode') == 'sprite' else parseBgTiles(image, options)
+def getSampleImage(streams, image, options):
+    '''used to provide output sample w/o having to load the created files in an SNES program'''
+    from PIL import Image
+    return Image.fromarray(convertColorsSnesToRGB(renderOutputStreams(streams, image, options)), 'RGB')
 
 
-def writeTileMap(tiles, palettes, options):
-    if options.get('mode') == 'sprite':
-        writeSpriteTileMap(tiles, palettes, options)
+def renderOutputStreams(streams, image, options):
+    '''
+    decodes tiles, tilemap & palette output streams the way the snes displays them,
+    returns (resolutionY, resolutionX) array of 15bit snes colors.
+    '''
+    tileWidth = options.get('tilesizex')
+    tileHeight = options.get('tilesizey')
+    tiles = decodeBitplaneStream(streams['tiles'], options.get('bpp'), tileHeight, tileWidth)
+    xPos, yPos, configs = decodeTileMapStream(streams['tilemap'], image, options)
+    palIds = getTileMapPaletteIds(configs, options)
+
+    # references to tiles that don't exist show up as empty tiles
+    tileIds = configs & 0x3ff
+    pixels = np.zeros((len(configs), tileHeight, tileWidth), dtype=np.uint8)
+    pixels[tileIds < len(tiles)] = tiles[tileIds[tileIds < len(tiles)]]
+    pixels = np.where(((configs >> 14) & 1).astype(bool)[:, np.newaxis, np.newaxis], pixels[:, :, ::-1], pixels)
+    pixels = np.where(((configs >> 15) & 1).astype(bool)[:, np.newaxis, np.newaxis], pixels[:, ::-1, :], pixels)
+
+    if options.get('directcolor'):
+        colors = convertDirectColorsToSnes(pixels)
     else:
-        writeBgTileMap(tiles, palettes, options)
+        # palette indices exceeding palette size or stream show up as EMPTY_COLOR, which is appended to the palette
+        colorCount = options.get('bpp') ** 2
+        palette = np.append(np.frombuffer(streams['palette'], dtype='<u2'), np.uint16(EMPTY_COLOR))
+        colorIds = palIds[:, np.newaxis, np.newaxis] * colorCount + pixels
+        colorIds[(pixels >= colorCount) | (colorIds >= len(palette))] = len(palette) - 1
+        colors = palette[colorIds]
+
+    sample = np.full((max([image['resolutionY']] + (yPos + tileHeight).tolist()),
+                      max([image['resolutionX']] + (xPos + tileWidth).tolist())), options.get('transcol'), dtype=np.uint16)
+    sample[yPos[:, np.newaxis, np.newaxis] + np.arange(tileHeight)[np.newaxis, :, np.newaxis],
+           xPos[:, np.newaxis, np.newaxis] + np.arange(tileWidth)[np.newaxis, np.newaxis, :]] = colors
+    return sample[:image['resolutionY'], :image['resolutionX']]
+
+
+def decodeTileMapStream(stream, image, options):
+    '''returns pixel position x, y and tilemap config of each tilemap entry as int64 arrays'''
+    if options.get('mode') == 'sprite':
+        entries = np.frombuffer(stream, dtype=np.uint8).reshape(-1, 4).astype(np.int64)
+        return entries[:, 0], entries[:, 1], entries[:, 2] | (entries[:, 3] << 8)
 
+    configs = np.frombuffer(stream, dtype='<u2').astype(np.int64)
+    blocksX = max(1, -(-image['resolutionX'] // (BG_TILEMAP_SIZE * options.get('tilesizex'))))
+    blockIds, tilePos = np.divmod(np.arange(len(configs)), BG_TILEMAP_SIZE * BG_TILEMAP_SIZE)
+    xPos = ((blockIds % blocksX) * BG_TILEMAP_SIZE + tilePos % BG_TILEMAP_SIZE) * options.get('tilesizex')
+    yPos = ((blockIds // blocksX) * BG_TILEMAP_SIZE + tilePos // BG_TILEMAP_SIZE) * options.get('tilesizey')
+    return xPos, yPos, configs
 
-def getBgTileMapStream(tiles, palettes, options):
-    '''writes successive blocks of 32x32 tile tilemaps'''
-    stream = []
-    bgTilemaps = getBgTilemaps(tiles, palettes, options)
-    for tile in [tile for tilemap in bgTilemaps for tile in tilemap]:
-        stream.append(bytes([tile & 0xff]))
-        stream.append(bytes([(tile & 0xff00) >> 8]))
-    return b''.join(stream)
 
+def getTileMapPaletteIds(configs, options):
+    return (configs >> 9) & 0x7 if options.get('mode') == 'sprite' else (configs >> 10) & 0x7
 
-def writeBgTileMap(tiles, palettes, options):
-    '''writes successive blocks of 32x32 tile tilemaps'''
-    bgTilemaps = getBgTilemaps(tiles, palettes, options)
-    outFile = getOutputFile(options, ext='tilemap')
-    for tile in [tile for tilemap in bgTilemaps for tile in tilemap]:
-        outFile.write(bytes((tile & 0xff,)))
-        outFile.write(bytes(((tile & 0xff00) >> 8,)))
-    outFile.close()
 
+def getPsnr(sample, sourceImage):
+    '''peak signal-to-noise ratio in dB of (height, width, 3) rgb sample against source image, compared within source image'''
+    source = np.asarray(sourceImage.convert('RGB'), dtype=np.float64)
+    difference = sample[:source.shape[0], :source.shape[1]].astype(np.float64) - source
+    meanSquareError = np.mean(difference ** 2)
+    return INFINITY if meanSquareError == 0 else 10 * math.log10(255 ** 2 / meanSquareError)
 
-def getBgTilemaps(tiles, palettes, options):
-    emptyTile = getEmptyTileConfig(tiles, palettes)
-    bgTilemaps = [[emptyTile['concatConfig'] for i in range(BG_TILEMAP_SIZE * BG_TILEMAP_SIZE)] for i in range(
-        getCurrentTilemap(options.get('resolutionx'), options.get('resolutiony'), options) + 1)]
-    for tile in tiles:
-        mapId = getCurrentTilemap(tile['x'], tile['y'], options)
-        tilePos = getPositionInTilemap(tile['x'], tile['y'], options)
-        tileConfig = fetchTileConfig(tile, tiles, palettes)['concatConfig']
 
-        try:
-            bgTilemaps[mapId][tilePos] = tileConfig
-        except IndexError:
-            logging.error(
-                'invalid tilemap access in getBgTilemaps, mapId: %s, tilePos: %s' % (mapId, tilePos))
-    return bgTilemaps
+def parseTiles(image, options):
+    return parseSpriteTiles(image, options) if options.get('mode') == 'sprite' else parseBgTiles(image, options)
 
 
-def getEmptyTileConfig(tiles, palettes):
-    '''scans for empty tile, returns fake value if none found '''
-    '''todo, do we really need an additional empty tile here sometimes?'''
-    emptyTiles = [tile for tile in tiles if tileIsEmpty(tile)]
-    try:
-        return fetchTileConfig(emptyTiles.pop(), tiles, palettes)
-    except IndexError:
-        return {'concatConfig': 0}
+def getBgTileMapStream(tiles, palettes, options):
+    '''writes successive blocks of 32x32 tile tilemaps'''
+    return getBgTilemaps(tiles, palettes, options).astype('<u2').tobytes()
 
 
-def tileIsEmpty(tile):
-    if tile['refId'] != None:
-        return False
-    for pixel in [pixel for scanline in tile['indexedPixel'] for pixel in scanline]:
-        if pixel != 0:
-            return False
-    return True
+def getBgTilemaps(tiles, palettes, options):
+    '''
+    returns (blocks, 32*32) uint16 array of tilemap entries.
+    image is split into blocks of 32x32 tiles, ordered left to right, then top to bottom.
+    entries not covered by any tile hold config of empty tile.
+    '''
+    tileConfigs = getTileConfigs(tiles, palettes)
+    bgConfigs = getBgTileConfigs(tileConfigs)
+    blockWidth = BG_TILEMAP_SIZE * options.get('tilesizex')
+    blockHeight = BG_TILEMAP_SIZE * options.get('tilesizey')
+    blocksX = max(1, -(-options.get('resolutionx') // blockWidth))
+    blocksY = max(1, -(-options.get('resolutiony') // blockHeight))
+    bgTilemaps = np.full((blocksX * blocksY, BG_TILEMAP_SIZE * BG_TILEMAP_SIZE),
+                         getEmptyTileConfig(tiles, bgConfigs), dtype=np.uint16)
+
+    blockX = tileConfigs['x'] // blockWidth
+    blockY = tileConfigs['y'] // blockHeight
+    mapIds = blockY * blocksX + blockX
+    tilePos = ((tileConfigs['y'] // options.get('tilesizey')) % BG_TILEMAP_SIZE) * BG_TILEMAP_SIZE + (
+        (tileConfigs['x'] // options.get('tilesizex')) % BG_TILEMAP_SIZE)
+    valid = (blockX >= 0) & (blockX < blocksX) & (blockY >= 0) & (blockY < blocksY)
+    for tileId in np.flatnonzero(~valid):
+        logging.error('invalid tilemap access in getBgTilemaps, tile position: %s, %s' % (
+            tileConfigs['x'][tileId], tileConfigs['y'][tileId]))
+    bgTilemaps[mapIds[valid], tilePos[valid]] = bgConfigs[valid]
+    return bgTilemaps
 
 
-def getPositionInTilemap(xPos, yPos, options):
-    xTilePos = int(math.floor(
-        (xPos / options.get('tilesizex')) % BG_TILEMAP_SIZE))
-    yTilePos = int(math.floor(
-        (yPos / options.get('tilesizey')) % BG_TILEMAP_SIZE))
-    return (BG_TILEMAP_SIZE * yTilePos) + xTilePos
+def getEmptyTileConfig(tiles, bgConfigs):
+    '''scans for last empty tile, returns its config or fake value if none found '''
+    '''todo, do we really need an additional empty tile here sometimes?'''
+    emptyTiles = np.flatnonzero(getEmptyTiles(tiles))
+    return int(bgConfigs[emptyTiles[-1]]) if len(emptyTiles) else 0
 
 
-def getCurrentTilemap(xPos, yPos, options):
-    return int(math.floor(xPos / float(BG_TILEMAP_SIZE * options.get('tilesizex'))) * math.floor(yPos / float(BG_TILEMAP_SIZE * options.get('tilesizey'))))
+def getEmptyTiles(tiles):
+    '''returns mask of actual tiles using color index 0 only'''
+    return (tiles.refId == NO_REFERENCE) & ~tiles.indexedPixel.reshape(len(tiles), -1).any(axis=1)
 
 
 def getSpriteTileMapStream(tiles, palettes, options):
-    stream = []
-    for tile in tiles:
-        tileConfig = fetchSpriteTileConfig(tile, tiles, palettes)
-        stream.append(bytes([tileConfig['x'] & 0xff]))
-        stream.append(bytes([tileConfig['y'] & 0xff]))
-        stream.append(bytes([tileConfig['concatConfig'] & 0xff]))
-        stream.append(bytes([(tileConfig['concatConfig'] & 0xff00) >> 8]))
-    return b''.join(stream)
-
-
-def writeSpriteTileMap(tiles, palettes, options):
-    outFile = getOutputFile(options, ext='spritemap')
-    for tile in tiles:
-        tileConfig = fetchSpriteTileConfig(tile, tiles, palettes)
-        outFile.write(bytes((tileConfig['concatConfig'] & 0xff,)))
-        outFile.write(bytes(((tileConfig['concatConfig'] & 0xff00) >> 8,)))
-        outFile.write(bytes((tileConfig['x'] & 0xff,)))
-        outFile.write(bytes((tileConfig['y'] & 0xff,)))
-    outFile.close()
+    '''4 bytes per tile: x, y, tilemap config'''
+    tileConfigs = getTileConfigs(tiles, palettes)
+    stream = np.zeros((len(tiles), 4), dtype=np.uint8)
+    stream[:, 0] = tileConfigs['x'] & 0xff
+    stream[:, 1] = tileConfigs['y'] & 0xff
+    stream[:, 2:] = getSpriteTileConfigs(tileConfigs).astype('<u2').view(np.uint8).reshape(-1, 2)
+    return stream.tobytes()
 
 
-def fetchTileConfig(tile, tiles, palettes):
-    actualTile = fetchActualTile(tiles, tile['id'], False, False)
-    actualPalette = fetchActualEntity(palettes, actualTile['palette']['id'])
-    x = 1 if actualTile['xMirror'] else 0
-    y = 1 if actualTile['yMirror'] else 0
+def getTileConfigs(tiles, palettes):
+    '''
+    resolves references of all tiles at once, returns dict of arrays holding config of each tile:
+    actual tile & palette ids and out ids, mirror state accumulated along reference chain and position.
+    '''
+    actualTileIds, xMirror, yMirror = resolveReferences(tiles.refId, tiles.xMirror, tiles.yMirror)
+    palRefIds = np.array([NO_REFERENCE if palette['refId'] == None else palette['refId'] for palette in palettes], dtype=np.int64)
+    palOutIds = np.array([NO_REFERENCE if palette.get('outId') == None else palette['outId'] for palette in palettes], dtype=np.int64)
+    actualPalIds = resolveReferences(palRefIds)[0][tiles.paletteId[actualTileIds]] if len(palettes) else np.zeros(len(tiles), dtype=np.int64)
     return {
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': actualTile['xMirror'],
-        'yMirror': actualTile['yMirror'],
-        'tileId': actualTile['id'],
-        'palId': actualPalette['id'],
-        'tileOutId': actualTile['outId'],
-        'palOutId': actualPalette['outId'],
-        'concatConfig': (y << 15) | (x << 14) | ((actualPalette['outId'] & 0x7) << 10) | (actualTile['outId'] & 0x3ff)
+        'x': tiles.x.astype(np.int64),
+        'y': tiles.y.astype(np.int64),
+        'xMirror': xMirror,
+        'yMirror': yMirror,
+        'tileId': actualTileIds,
+        'palId': actualPalIds,
+        'tileOutId': tiles.outId[actualTileIds].astype(np.int64),
+        'palOutId': palOutIds[actualPalIds] if len(palettes) else np.zeros(len(tiles), dtype=np.int64)
     }
 
 
-def fetchSpriteTileConfig(tile, tiles, palettes):
-    actualTile = fetchActualTile(tiles, tile['id'], False, False)
-    actualPalette = fetchActualEntity(palettes, actualTile['palette']['id'])
+def getBgTileConfigs(tileConfigs):
+    '''bg tilemap entries, format: vhopppcc cccccccc'''
+    return ((tileConfigs['yMirror'].astype(np.int64) << 15) | (tileConfigs['xMirror'].astype(np.int64) << 14)
+            | ((tileConfigs['palOutId'] & 0x7) << 10) | (tileConfigs['tileOutId'] & 0x3ff))
+
+
+def getSpriteTileConfigs(tileConfigs):
+    '''sprite tilemap entries, format: vhoopppN cccccccc'''
     priority = 0x3
     nametable = 0x0
-    x = 1 if tile['xMirror'] else 0
-    y = 1 if tile['yMirror'] else 0
-    return {
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': tile['xMirror'],
-        'yMirror': tile['yMirror'],
-        'tileId': actualTile['id'],
-        'palId': actualPalette['id'],
-        'tileOutId': actualTile['outId'],
-        'palOutId': actualPalette['outId'],
-        'concatConfig': (y << 15) | (x << 14) | (priority << 12) | ((actualPalette['outId'] & 0x7) << 9) | (nametable << 8) | (actualTile['outId'] & 0x3ff)
-    }
+    return ((tileConfigs['yMirror'].astype(np.int64) << 15) | (tileConfigs['xMirror'].astype(np.int64) << 14)
+            | (priority << 12) | ((tileConfigs['palOutId'] & 0x7) << 9) | (nametable << 8) | (tileConfigs['tileOutId'] & 0x3ff))
 
 
 '''
@@ -505,32 +813,13 @@ target format sprite tilemap:
 '''
 
 
-def writeTiles(tiles, options):
-    outFile = getOutputFile(options, ext='tiles')
-    for tile in tiles:
-        if tile['refId'] == None:
-            writeBitplaneTile(outFile, tile, options)
-    outFile.close()
-
-
-def writeBitplaneTile(outFile, tile, options):
-    bitplanes = fetchBitplanes(tile, options)
-    for i in range(0, len(bitplanes), 2):
-        while bitplanes[i].notEmpty():
-            outFile.write(bytes((bitplanes[i].first(),)))
-            outFile.write(bytes((bitplanes[i+1].first(),)))
-
-
 def getTileWriteStream(tiles, options):
-    stream = []
-    for tile in tiles:
-        if tile['refId'] == None:
-            bitplanes = fetchBitplanes(tile, options)
-            for i in range(0, len(bitplanes), 2):
-                while bitplanes[i].notEmpty():
-                    stream.append(bytes([bitplanes[i].first()]))
-                    stream.append(bytes([bitplanes[i+1].first()]))
-    return b''.join(stream)
+    actual = tiles.refId == NO_REFERENCE
+    if options.get('directcolor'):
+        pixels = convertColorsSnesToDirectColor(tiles.pixel[actual])
+    else:
+        pixels = tiles.indexedPixel[actual]
+    return getBitplaneStream(pixels, options.get('bpp'))
 
 
 def getPaletteWriteStream(palettes, options):
@@ -541,22 +830,40 @@ def getPaletteWriteStream(palettes, options):
     return bytes(stream)
 
 
-def fetchBitplanes(tile, options):
-    bitplanes = []
-    for bitPlane in range(options.get('bpp')):
-        bitplaneTile = BitStream()
-        # debugLog(tile['pixel'],'native')
-        # debugLogExit(tile['indexedPixel'],'indexed')
-        target = 'pixel' if options.get('directcolor') else 'indexedPixel'
-        for pixel in [pixel for scanline in tile[target] for pixel in scanline]:
-            if options.get('directcolor'):
-                # source: -bbbbbgg gggrrrrr target: BBGGGRRR
-                # pixel = ((pixel & 0x7c00) >> 10) | ((pixel & 0x380) >> 7) | ((pixel & 0x1c) >> 2)
-                pixel = (((pixel & 0x6000) >> 7) | (
-                    (pixel & 0x380) >> 4) | ((pixel & 0x1c) >> 2))
-            bitplaneTile.writeBit(pixel >> bitPlane)
-        bitplanes.append(bitplaneTile)
-    return bitplanes
+def getBitplaneStream(pixels, bpp):
+    '''
+    encodes (N, tilesizey, tilesizex) color indices as snes planar tiles.
+    each tile holds bitplane pairs, each pair interleaves bytes of its two planes:
+    [plane0 byte0][plane1 byte0][plane0 byte1][plane1 byte1]..[plane2 byte0][plane3 byte0]..
+    '''
+    count = len(pixels)
+    pixels = pixels.reshape(count, -1).astype(np.uint8)
+    bytesPerPlane = pixels.shape[1] // 8
+    # (N, bpp, pixels) bits, msb of each byte is leftmost pixel
+    bits = (pixels[:, np.newaxis, :] >> np.arange(bpp, dtype=np.uint8)[np.newaxis, :, np.newaxis]) & 1
+    planes = np.packbits(bits, axis=2)[:, :, :bytesPerPlane]
+    return planes.reshape(count, bpp // 2, 2, bytesPerPlane).swapaxes(2, 3).tobytes()
+
+
+def convertColorsSnesToDirectColor(pixels):
+    '''source: -bbbbbgg gggrrrrr target: BBGGGRRR'''
+    return (((pixels & 0x6000) >> 7) | ((pixels & 0x380) >> 4) | ((pixels & 0x1c) >> 2)).astype(np.uint8)
+
+
+def convertDirectColorsToSnes(pixels):
+    '''source: BBGGGRRR target: -bb---gg g--rrr--'''
+    pixels = pixels.astype(np.uint16)
+    return ((pixels & 0xc0) << 7) | ((pixels & 0x38) << 4) | ((pixels & 0x7) << 2)
+
+
+def decodeBitplaneStream(stream, bpp, tileHeight, tileWidth):
+    '''inverse of getBitplaneStream, returns (N, tileHeight, tileWidth) uint8 color indices'''
+    bytesPerPlane = tileHeight * tileWidth // 8
+    planes = np.frombuffer(stream, dtype=np.uint8).reshape(-1, bpp // 2, bytesPerPlane, 2).swapaxes(2, 3)
+    count = len(planes)
+    bits = np.unpackbits(planes.reshape(count, bpp, bytesPerPlane), axis=2)
+    pixels = np.bitwise_or.reduce(bits << np.arange(bpp, dtype=np.uint8)[np.newaxis, :, np.newaxis], axis=1)
+    return pixels.reshape(count, tileHeight, tileWidth)
 
 
 def writePalettes(palettes, options):
@@ -578,141 +885,92 @@ def getOutputFile(options, ext):
 
 
 def palettizeTiles(tiles, palettes):
-    '''replaces direct tile colors with best-matching entries of assigned palette'''
-    # Shared cache across all tiles for performance
-    colorCache = {}
-    result = []
-    for tile in tiles:
-        if tile['refId'] != None:
-            result.append(tile)
-        else:
-            result.append(palettizeTile(tile, palettes, colorCache))
+    '''
+    replaces direct tile colors with best-matching entries of assigned palette.
+    each tile is assigned the first palette with the lowest total error(square root of summed square pixel errors).
+    each pixel is matched to the last most similar palette entry, its index is the first index of that color in the palette.
+    '''
+    result = tiles.copy()
+    actualPalettes = [pal for pal in palettes if pal['refId'] == None]
+    actual = np.flatnonzero(tiles.refId == NO_REFERENCE)
+    if not len(actual) or not actualPalettes:
+        return result
+
+    # distinct image colors and their lookup tables per palette
+    colors, colorIds = np.unique(tiles.pixel[actual], return_inverse=True)
+    colorIds = colorIds.reshape(len(actual), -1)
+    lut = getPaletteLookupTables(colors, actualPalettes)
+
+    # (tiles, palettes, pixels), summed sequentially to match float rounding of scalar accumulation
+    pixelErrors = lut['squareError'][colorIds].swapaxes(1, 2)
+    tileErrors = np.sqrt(np.cumsum(pixelErrors, axis=2)[:, :, -1])
+    optimumPalettes = np.argmin(tileErrors, axis=1)
+
+    pixelShape = tiles.pixel.shape[1:]
+    result.indexedPixel[actual] = lut['index'][colorIds, optimumPalettes[:, np.newaxis]].reshape((-1,) + pixelShape)
+    result.pixel[actual] = lut['color'][colorIds, optimumPalettes[:, np.newaxis]].reshape((-1,) + pixelShape)
+    result.paletteId[actual] = np.array([pal['id'] for pal in actualPalettes])[optimumPalettes]
     return result
 
 
-def findOptimumTilePalette(palettes, pixels, colorCache=None):
-    if colorCache is None:
-        colorCache = {}
-    
-    optimumPalette = {'error': INFINITY}
-    for palette in [pal for pal in palettes if pal['refId'] == None]:
-        squareError = 0
-        palId = palette['id']
-        for scanline in pixels:
-            for pixel in scanline:
-                # Use cache for color lookups
-                cacheKey = (pixel, palId)
-                if cacheKey in colorCache:
-                    similarColor = colorCache[cacheKey]
-                else:
-                    similarColor = getSimilarColor(pixel, palette['color'])
-                    colorCache[cacheKey] = similarColor
-                squareError += similarColor['error'] * similarColor['error']
-        palette['error'] = math.sqrt(squareError)
-        optimumPalette = palette if palette['error'] < optimumPalette['error'] else optimumPalette
-    return optimumPalette
-
-
-def palettizeTile(tile, palettes, colorCache=None):
-    if colorCache is None:
-        colorCache = {}
-    # logging.debug('palettizing tile %s' % tile['id'])
-    palette = findOptimumTilePalette(palettes, tile['pixel'], colorCache)
-
-    indexedScanlines = []
-    scanlines = []
-
-    for scanline in tile['pixel']:
-        indexedPixels = []
-        pixels = []
-        for pixel in scanline:
-            # Use cache for color lookups
-            cacheKey = (pixel, palette['id'])
-            if cacheKey in colorCache:
-                similarColor = colorCache[cacheKey]
-            else:
-                similarColor = getSimilarColor(pixel, palette['color'])
-                colorCache[cacheKey] = similarColor
-            indexedPixels.append(palette['color'].index(similarColor['value']))
-            pixels.append(similarColor['value'])
-        # indexedPixels.append( [getSimilarColorIndex( pixel, palette['color'] ) for pixel in scanline] )
-        scanlines.append(pixels)
-        indexedScanlines.append(indexedPixels)
+def getPaletteLookupTables(colors, palettes):
+    '''
+    nearest palette entry of each color in each palette, see getSimilarColor.
+    returns dict of (colors, palettes) arrays: matched color, its first index in palette, squared float error.
+    '''
+    entryCount = max(len(pal['color']) for pal in palettes)
+    entries = np.array([pal['color'] + [pal['color'][-1]] * (entryCount - len(pal['color'])) for pal in palettes], dtype=np.int64)
+    # padding repeats last entry, which never changes the last most similar entry
+    squareErrors = getColorSquareErrors(colors.astype(np.int64)[:, np.newaxis, np.newaxis], entries[np.newaxis, :, :])
+    lastNearest = entryCount - 1 - np.argmin(squareErrors[:, :, ::-1], axis=2)
+
+    paletteIds = np.arange(len(palettes))[np.newaxis, :]
+    nearestColors = entries[paletteIds, lastNearest]
+    firstIndices = np.array([[pal['color'].index(color) for color in row] for pal, row in zip(palettes, entries.tolist())])
     return {
-        'indexedPixel': indexedScanlines,
-        'pixel': scanlines,
-        'palette': {
-            'color': [],
-            'id': palette['id'],
-            'refId': None
-        },
-        'id': tile['id'],
-        'refId': tile['refId'],
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': tile['xMirror'],
-        'yMirror': tile['yMirror']
+        'color': nearestColors.astype(np.uint16),
+        'index': firstIndices[paletteIds, lastNearest].astype(np.uint8),
+        'squareError': np.sqrt(np.take_along_axis(squareErrors, lastNearest[:, :, np.newaxis], axis=2)[:, :, 0].astype(np.float64)) ** 2
     }
 
 
-def fetchActualTile(entities, entityId, xStatus, yStatus):
-    if entities[entityId]['refId'] == None:
-        # logging.debug('actual    %s[%s%s]' % (entityId, 'X' if entities[entityId]['xMirror'] else 'x', 'Y' if entities[entityId]['yMirror'] else 'y'))
-        tile = entities[entityId]
-        tile['xMirror'] = xStatus
-        tile['yMirror'] = yStatus
-        return tile
-        '''
-    return {
-      'indexedPixel'  : entities[entityId]['indexedScanlines'],
-      'pixel'         : entities[entityId]['scanlines'],
-      'palette'       : entities[entityId]['palette'],
-      'id'            : entities[entityId]['id'],
-      'refId'         : entities[entityId]['refId'],
-      'x'             : entities[entityId]['x'],
-      'y'             : entities[entityId]['y'],
-      'xMirror'       : xStatus,
-      'yMirror'       : yStatus
-    }
+def resolveReferences(refIds, *flags):
     '''
-        # tile = entities[entityId]
-
-    else:
-        # logging.debug('reference %s[%s%s]->%s[%s%s]' % (entityId, 'X' if entities[entityId]['xMirror'] else 'x', 'Y' if entities[entityId]['yMirror'] else 'y', entities[entityId]['refId'], 'X' if entities[entities[entityId]['refId']]['xMirror'] else 'x', 'Y' if entities[entities[entityId]['refId']]['yMirror'] else 'y'))
-        return fetchActualTile(entities, entities[entityId]['refId'], entities[entityId]['xMirror'] ^ xStatus, entities[entityId]['yMirror'] ^ yStatus)
-
-        # beide gesetzt:0
-        # 1 gesetzt: 1
-        # keins gesetzt: 0
-        '''
-    debugLog({
-      'id'  : tile['id'],
-      'refId'  : tile['refId'],
-      'xMirror'  : tile['xMirror'],
-      'yMirror'  : tile['yMirror'],
-    }, 'tile %s[%s%s]->%s[%s%s]' % tile['id'])
+    follows reference chains of all entities at once, returns id of actual entity each one resolves to.
+    every step points each entity to its reference's reference (pointer jumping), so chains of any length
+    resolve in log2(length) vectorized steps. each flags array is xor-accumulated along the chain,
+    flags of actual entities are ignored.
     '''
-        # tile['yMirror'] = tile['yMirror'] ^ entities[entityId]['yMirror']
-        # tile['xMirror'] = tile['xMirror'] ^ entities[entityId]['xMirror']
-
-    # logging.debug('returning %s[%s%s]' % (tile['id'], 'X' if tile['xMirror'] else 'x', 'Y' if tile['yMirror'] else 'y'))
-    # return tile
-
+    refIds = np.asarray(refIds)
+    referenced = refIds != NO_REFERENCE
+    actualIds = np.where(referenced, refIds, np.arange(len(refIds))).astype(np.int64)
+    flags = [np.asarray(flag, dtype=bool) & referenced for flag in flags]
+    while True:
+        nextIds = actualIds[actualIds]
+        if np.array_equal(nextIds, actualIds):
+            return (actualIds, *flags)
+        flags = [flag ^ flag[actualIds] for flag in flags]
+        actualIds = nextIds
 
-def fetchActualEntity(entities, entityId):
-    return entities[entityId] if entities[entityId]['refId'] == None else fetchActualEntity(entities, entities[entityId]['refId'])
 
-
-def parsePalettes(tiles, options):
-    return [reducePaletteColorDepth(tile['palette'], options) for tile in tiles]
+def parseGlobalPalettes(tiles, options):
+    globalPalette = reducePalette(fetchGlobalPalette(tiles, options),
+                                  ((options.get('bpp') ** 2) - 1) * options.get('palettes'))
+    return partitionGlobalPalette(globalPalette, options)
 
 
-def parseGlobalPalettes(tiles, options):
-    globalPalette = fetchGlobalPalette(tiles, options)
-    while (len(globalPalette) > (((options.get('bpp') ** 2) - 1) * options.get('palettes'))):
-        nearestIndices = getNearestPaletteIndices(globalPalette)
-        globalPalette.pop(max(nearestIndices['id1'], nearestIndices['id2']))
-        # logging.debug('global palette length now at %s, target is %s.' % (len(globalPalette), (((options.get('bpp') ** 2) - 1) * options.get('palettes'))))
+def parseHistogramPalettes(colors, counts, options):
+    '''
+    global palettes of color histogram, e.g. of all frames of an animation.
+    colors are in order of first appearance, counts are pixel counts of each color or None.
+    of similar colors, the less frequent one is dropped. without counts, palettes equal those of parseGlobalPalettes.
+    '''
+    sortedColors = getHueSortedColors(colors, options)
+    sortedCounts = None
+    if counts is not None:
+        colorCounts = dict(zip(colors, counts))
+        sortedCounts = [colorCounts[color] for color in sortedColors]
+    globalPalette = reducePalette(sortedColors, ((options.get('bpp') ** 2) - 1) * options.get('palettes'), sortedCounts)
     return partitionGlobalPalette(globalPalette, options)
 
 
@@ -740,12 +998,16 @@ def partitionGlobalPalette(palettes, options):
 def fetchGlobalPalette(tiles, options):
     refPaletteImg = getReferencePaletteImage(options)
     if refPaletteImg:
-        return [color for color in set([pixel for scanline in refPaletteImg['pixels'] for pixel in scanline if pixel != options.get('transcol')])]
+        return [color for color in set([pixel for pixel in refPaletteImg['pixels'].ravel().tolist() if pixel != options.get('transcol')])]
     else:
-        return sorted(
-            [color for color in set([color for tile in tiles for color in tile['palette']['color'] if color != options.get('transcol')])],
-            key=cmp_to_key(sortSNESColors)
-        )
+        return getHueSortedColors(tiles.getColors(), options)
+
+
+def getHueSortedColors(colors, options):
+    '''distinct colors except transparent one, sorted by hue'''
+    colors = [color for color in set([color for color in colors if color != options.get('transcol')])]
+    hues = getColorHues(COLOR_RED[colors], COLOR_GREEN[colors], COLOR_BLUE[colors])
+    return [colors[index] for index in np.argsort(hues, kind='stable')]
 
 
 def checkPaletteCount(palettes, options):
@@ -800,387 +1062,362 @@ def getSimilarColorIndex(color, refPalette):
 
 
 def reducePaletteColorDepth(palette, options):
-    while len(palette['color']) > (options.get('bpp') * options.get('bpp')):
-        nearestIndices = getNearestPaletteIndices(palette['color'])
-        palette['color'].pop(max(nearestIndices['id1'], nearestIndices['id2']))
+    palette['color'] = reducePalette(palette['color'], options.get('bpp') * options.get('bpp'))
     return palette
 
 
-def getNearestPaletteIndices(palette):
-    diffTable = {}
-    for i in range(1, len(palette)):
-        for iRef in range(1, len(palette)):
-            if i != iRef:
-                diffIndex = "%s-%s" % (min(i, iRef), max(i, iRef))
-                diffTable[diffIndex] = {
-                    'difference': compareSNESColors(palette[i], palette[iRef]),
-                    'id1': i,
-                    'id2': iRef
-                }
-    return getMinDifferenceIds(diffTable)
-
+def reducePalette(colors, colorCount, counts=None):
+    '''
+    repeatedly drops the latter color of the most similar color pair until no more than colorCount colors remain.
+    first color is never considered. of equally similar pairs (i, j), i < j, the one with lowest i, then lowest j is merged.
+    if pixel counts of colors are given, the less frequent color of the pair is dropped instead(the latter one on equal counts),
+    its count is added to the remaining one.
 
-def getMinDifferenceIds(diffTable):
-    minDiff = {'difference': INFINITY}
-    for diffName, diff in diffTable.items():
-        minDiff = diff if diff['difference'] < minDiff['difference'] else minDiff
-    return minDiff
+    keeps the most similar remaining partner of each color, so after each drop,
+    only colors that had the dropped one as nearest partner need to be rescanned.
+    '''
+    if len(colors) <= colorCount:
+        return list(colors)
+
+    count = len(colors)
+    colorArray = np.array(colors, dtype=np.int64)
+    # square errors preserve order of compareSNESColors and are exact integers
+    distances = getColorSquareErrors(colorArray[:, np.newaxis], colorArray[np.newaxis, :])
+    distances[~np.triu(np.ones((count, count), dtype=bool), k=1)] = NO_DISTANCE
+    distances[0] = NO_DISTANCE
+
+    rowIds = np.arange(count)
+    if counts is not None:
+        counts = np.array(counts, dtype=np.float64)
+    nearest = distances.argmin(axis=1)
+    nearestDistance = distances[rowIds, nearest]
+    remaining = np.ones(count, dtype=bool)
+    for _ in range(count - colorCount):
+        colorId = int(nearestDistance.argmin())
+        if nearestDistance[colorId] == NO_DISTANCE:
+            # less than two mergeable colors left
+            break
+        droppedId = nearest[colorId]
+        if counts is not None:
+            if counts[droppedId] > counts[colorId]:
+                colorId, droppedId = droppedId, colorId
+            counts[colorId] += counts[droppedId]
+        remaining[droppedId] = False
+        distances[droppedId] = NO_DISTANCE
+        distances[:, droppedId] = NO_DISTANCE
+        nearestDistance[droppedId] = NO_DISTANCE
+
+        stale = np.flatnonzero((nearest == droppedId) & remaining)
+        nearest[stale] = distances[stale].argmin(axis=1)
+        nearestDistance[stale] = distances[stale, nearest[stale]]
+
+    return [color for color, keep in zip(colors, remaining.tolist()) if keep]
+
+
+def getColorSquareErrors(colors1, colors2):
+    '''vectorized square of compareSNESColors for broadcastable integer arrays'''
+    r1, g1, b1 = COLOR_RED[colors1], COLOR_GREEN[colors1], COLOR_BLUE[colors1]
+    r2, g2, b2 = COLOR_RED[colors2], COLOR_GREEN[colors2], COLOR_BLUE[colors2]
+    redMean = (r1 + r2) // 2
+    r = r1 - r2
+    g = g1 - g2
+    b = b1 - b2
+    return (((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8)
 
 
 def optimizeTiles(tiles, options):
-    import numpy as np
-    
-    # Extract all pixels into a numpy array for fast comparison
-    # Shape: (N, 8, 8) containing 15-bit SNES colors
-    num_tiles = len(tiles)
-    if num_tiles == 0:
+    '''
+    marks tiles that are (possibly mirrored) duplicates of any preceding tile as reference to the most similar one.
+    ties are resolved in favour of the unmirrored tile, then x-, y-, and xy-mirror, then the lowest tile id.
+    '''
+    threshold = float(options.get('tilethreshold'))
+    if len(tiles) < 2 or threshold <= 0:
         return tiles
 
-    # Pre-convert all tiles to RGB for distance calculation
-    # SNES color: -bbbbbgg gggrrrrr
-    # We need to extract r, g, b components
-    
-    # Flatten pixels to (N, 64)
-    raw_pixels = []
-    for tile in tiles:
-        flat = [p for row in tile['pixel'] for p in row]
-        raw_pixels.append(flat)
-    
-    raw_pixels = np.array(raw_pixels, dtype=np.uint16) # (N, 64)
-    
-    # Extract RGB components
-    # r = (color & 0x1f)
-    # g = (color & 0x3E0) >> 5
-    # b = (color & 0x7C00) >> 10
-    
-    r = (raw_pixels & 0x1f).astype(np.float32)
-    g = ((raw_pixels & 0x3E0) >> 5).astype(np.float32)
-    b = ((raw_pixels & 0x7C00) >> 10).astype(np.float32)
-    
-    # Stack to (N, 64, 3)
-    # tile_rgb[i, p, 0] = r
-    tile_rgb = np.stack([r, g, b], axis=2)
-    
-    threshold = float(options.get('tilethreshold'))
-    
-    # Iterate through tiles
-    for i in range(num_tiles):
-        current_tile = tiles[i]
-        
-        # If we want to look back at all previous tiles
-        # We can compare tile_rgb[i] against tile_rgb[0:i]
-        if i == 0:
-            continue
-            
-        # Prepare target tile (and its mirrors)
-        # Mirrors: 
-        # 0: original
-        # 1: x-mirror
-        # 2: y-mirror
-        # 3: xy-mirror
-        
-        # Reshape to (8, 8, 3) for mirroring
-        curr_img = tile_rgb[i].reshape(8, 8, 3)
-        
-        mirrors = []
-        mirrors.append(curr_img.reshape(64, 3)) # Original
-        mirrors.append(curr_img[:, ::-1, :].reshape(64, 3)) # X mirror
-        mirrors.append(curr_img[::-1, :, :].reshape(64, 3)) # Y mirror
-        mirrors.append(curr_img[::-1, ::-1, :].reshape(64, 3)) # XY mirror
-        
-        mirrors = np.stack(mirrors) # (4, 64, 3)
-        
-        # Reference tiles: (i, 64, 3)
-        refs = tile_rgb[:i]
-        
-        # We need to compute weighted Euclidean distance
-        # redMean = (c1.r + c2.r) / 2
-        # r_diff = c1.r - c2.r
-        # g_diff = c1.g - c2.g
-        # b_diff = c1.b - c2.b
-        # dist = sqrt( ((512+rm)*r*r)>>8 + 4*g*g + ((767-rm)*b*b)>>8 )
-        
-        # Vectorized calculation
-        # We want to compare 4 mirrors against i refs.
-        # Broadcast: (4, 1, 64, 3) vs (1, i, 64, 3) -> (4, i, 64, 3)
-        
-        m_exp = mirrors[:, np.newaxis, :, :]
-        r_exp = refs[np.newaxis, :, :, :]
-        
-        rm = (m_exp[..., 0] + r_exp[..., 0]) * 0.5
-        rd = m_exp[..., 0] - r_exp[..., 0]
-        gd = m_exp[..., 1] - r_exp[..., 1]
-        bd = m_exp[..., 2] - r_exp[..., 2]
-        
-        # Compute squared error per pixel
-        # ((512+rm)*rd*rd)/256 + 4*gd*gd + ((767-rm)*bd*bd)/256
-        
-        term1 = ((512 + rm) * rd * rd) / 256.0
-        term2 = 4 * gd * gd
-        term3 = ((767 - rm) * bd * bd) / 256.0
-        
-        sq_err_pixel = term1 + term2 + term3
-        
-        # Sum over pixels (axis 2) -> (4, i)
-        # Then sqrt
-        err_total = np.sqrt(np.sum(sq_err_pixel, axis=2))
-        
-        # Find minimum error
-        min_err = np.min(err_total)
-        
-        if min_err < threshold:
-            # Found a match
-            # Get index of match
-            min_idx_flat = np.argmin(err_total)
-            # Unravel index
-            mirror_idx, ref_idx = np.unravel_index(min_idx_flat, err_total.shape)
-            
-            # Update tile
-            current_tile['refId'] = tiles[ref_idx]['id']
-            current_tile['pixel'] = [] # Clear data
-            current_tile['indexedPixel'] = []
-            current_tile['palette']['refId'] = tiles[ref_idx]['palette']['id']
-            current_tile['xMirror'] = (mirror_idx == 1) or (mirror_idx == 3)
-            current_tile['yMirror'] = (mirror_idx == 2) or (mirror_idx == 3)
-            
-            # Update palette ref if needed? 
-            # The original code does:
-            # 'refId': refTile['palette']['id']
-            # So we point to the reference tile's palette.
-            
+    return applyNearestTiles(tiles, findNearestTiles(tiles, threshold), threshold)
+
+
+def optimizeTilesWithinBudget(tiles, options):
+    '''
+    optimizeTiles, but raises tilethreshold in steps of TILE_THRESHOLD_STEP until no more than maxtiles actual tiles remain.
+    the most similar tile of each tile does not depend on the threshold, so nearest matches are searched once
+    and each threshold step is just a count of nearest errors below it.
+    '''
+    threshold = options.get('tilethreshold')
+    if len(tiles) < 2 or (threshold <= 0 and len(tiles) <= options.get('maxtiles')):
+        return optimizeTiles(tiles, options)
+
+    maxTileError = MAX_COLOR_ERROR * math.sqrt(tiles.pixel.shape[1] * tiles.pixel.shape[2])
+    # threshold 0 references no tiles at all, search starts at first step above it
+    radius = float(max(threshold, TILE_THRESHOLD_STEP))
+    while True:
+        nearest = findNearestTiles(tiles, radius)
+        sortedErrors = np.sort(nearest[0])
+        # steps up to search radius are exact, as all errors below radius are known
+        thresholds = np.arange(threshold, math.floor(radius) + 1, TILE_THRESHOLD_STEP)
+        actualCounts = len(tiles) - np.searchsorted(sortedErrors, thresholds, side='left')
+        fitting = np.flatnonzero(actualCounts <= options.get('maxtiles'))
+        if len(fitting):
+            fittingThreshold = int(thresholds[fitting[0]])
+            break
+        if radius > maxTileError:
+            fittingThreshold = int(thresholds[-1])
+            logging.warning('unable to fit tiles into maxtiles %s, using threshold %s.' % (
+                options.get('maxtiles'), fittingThreshold))
+            break
+        radius *= 2
+
+    if fittingThreshold != threshold:
+        logging.info('maxtiles %s exceeded at threshold %s, using threshold %s.' % (
+            options.get('maxtiles'), threshold, fittingThreshold))
+        options.set('tilethreshold', fittingThreshold)
+    return applyNearestTiles(tiles, nearest, fittingThreshold)
+
+
+def applyNearestTiles(tiles, nearest, threshold):
+    '''references every tile whose nearest match is below threshold'''
+    errors, refIds, mirrorIds = nearest
+    matched = errors < threshold
+    tiles.refId = np.where(matched, refIds, NO_REFERENCE).astype(np.int32)
+    tiles.xMirror = matched & ((mirrorIds == MIRROR_X) | (mirrorIds == MIRROR_XY))
+    tiles.yMirror = matched & ((mirrorIds == MIRROR_Y) | (mirrorIds == MIRROR_XY))
     return tiles
 
-def checkDuplicateTile(tile, refTiles, options):
-    pass # Replaced by numpy version
 
-def checkDuplicateTileFast(tile, refTiles, options):
-    pass # Replaced by numpy version
+def findNearestTiles(tiles, radius):
+    '''
+    searches most similar preceding tile of each tile, as long as its error is below radius.
+    returns (errors, refIds, mirrorIds) arrays, error is INFINITY where no such tile exists.
+    '''
+    if radius * radius <= MIN_TILE_SQUARE_ERROR:
+        # smallest possible difference between non-identical tiles exceeds radius, only exact duplicates qualify
+        return findIdenticalTiles(tiles)
+    return findSimilarTiles(tiles, radius)
 
 
-def compareTile(inputTile, refTile):
-    squareError = 0
-    inPixels = [pixel for scanline in inputTile['pixel'] for pixel in scanline]
-    refPixels = [pixel for scanline in refTile['pixel'] for pixel in scanline]
-    for error in [compareSNESColors(inPixels[i], refPixels[i]) for i in range(len(inPixels))]:
-        squareError += error * error
-    return {
-        'id': inputTile['id'],
-        'pixel': [],
-        'palette': {
-            'color': [],
-            'id': inputTile['palette']['id'],
-            'refId': refTile['palette']['id']
-        },
-        'x': inputTile['x'],
-        'y': inputTile['y'],
-        'refId': refTile['id'],
-        'error': math.sqrt(squareError),
-        'xMirror': inputTile['xMirror'],
-        'yMirror': inputTile['yMirror']
-    }
+def getMirroredPixels(pixels):
+    '''returns all mirrored variants of (..., tilesizey, tilesizex) pixels, ordered by mirror id'''
+    return (
+        pixels,
+        pixels[..., :, ::-1],
+        pixels[..., ::-1, :],
+        pixels[..., ::-1, ::-1]
+    )
 
 
-def mirrorTiles(tile):
-    return [
-        tile,
-        mirrorTile(tile, {'x': True, 'y': False}),
-        mirrorTile(tile, {'x': False, 'y': True}),
-        mirrorTile(tile, {'x': True, 'y': True}),
-    ]
-
-
-def mirrorTile(tile, config):
-    mirrorTile = []
-    verticalRange = range(
-        len(tile['pixel'])-1, 0-1, -1) if config['y'] else range(len(tile['pixel']))
-    for yPos in verticalRange:
-        horizontalRange = range(len(
-            tile['pixel'][yPos])-1, 0-1, -1) if config['x'] else range(len(tile['pixel'][yPos]))
-        mirrorTile.append([tile['pixel'][yPos][xPos]
-                          for xPos in horizontalRange])
-    return {
-        'id': tile['id'],
-        'pixel': mirrorTile,
-        'palette': tile['palette'],
-        'x': tile['x'],
-        'y': tile['y'],
-        'refId': None,
-        'xMirror': config['x'],
-        'yMirror': config['y']
-    }
+def findIdenticalTiles(tiles):
+    '''hash lookup of mirrored tiles, see findNearestTiles'''
+    matcher = IdenticalTileMatcher(tiles)
+    nearest = getEmptyNearestTiles(len(tiles))
+    for tileId in range(len(tiles)):
+        match = matcher.find(tileId)
+        if match:
+            setNearestTile(nearest, tileId, match, 0.0)
+        matcher.add(tileId)
+    return nearest
 
 
-def sortSNESColors(SNESCol1, SNESCol2):
-    color1 = ColObj(SNESCol1)
-    color2 = ColObj(SNESCol2)
-    return -1 if color1.getHue() - color2.getHue() < 0 else 1
+def getEmptyNearestTiles(count):
+    return (
+        np.full(count, INFINITY),
+        np.full(count, NO_REFERENCE, dtype=np.int32),
+        np.full(count, MIRROR_NONE, dtype=np.int8)
+    )
 
 
-def compareSNESColors(SNESCol1, SNESCol2):
-    color1 = ColObj(SNESCol1)
-    color2 = ColObj(SNESCol2)
-    redMean = (color1.r + color2.r) // 2
-    r = color1.r - color2.r
-    g = color1.g - color2.g
-    b = color1.b - color2.b
-    return math.sqrt((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8))
+def setNearestTile(nearest, tileId, match, error):
+    nearest[0][tileId] = error
+    nearest[1][tileId] = match[0]
+    nearest[2][tileId] = match[1]
 
 
-def compareSNESColor(col1, col2):
-    return max(col1, col2) - min(col1, col2)
+def findSimilarTiles(tiles, radius):
+    '''
+    nearest match search for nonzero radius, see findNearestTiles.
 
+    exact duplicates are looked up by hash first, since no other tile can beat their error of 0.
+    otherwise, tile error is bounded below by the error between mean tile colors, which is the same for all mirrors.
+    tiles are bucketed by their scaled mean color in a grid of threshold-sized cells,
+    so only tiles of neighbouring cells have to be compared pixel by pixel.
+    of several identical tiles, only the first one is ever picked, so only that one goes into the grid.
+    '''
+    count = len(tiles)
+    pixelCount = tiles.pixel.shape[1] * tiles.pixel.shape[2]
+    components = getColorComponents(tiles.pixel).reshape(count, pixelCount, 3)
+    mirrors = np.stack([getColorComponents(mirror).reshape(count, pixelCount, 3) for mirror in getMirroredPixels(tiles.pixel)])
+
+    # euclidean distance of these equals lower bound of tile error
+    signatures = components.mean(axis=1, dtype=np.float64) * np.sqrt(pixelCount * MIN_COLOR_ERROR_WEIGHTS)
+    cellSize = radius * (1 + TILE_ERROR_TOLERANCE)
+    cells = np.floor(signatures / cellSize).astype(np.int64)
+    neighbourOffsets = [(r, g, b) for r in (-1, 0, 1) for g in (-1, 0, 1) for b in (-1, 0, 1)]
+
+    matcher = IdenticalTileMatcher(tiles)
+    grid = {}
+    nearest = getEmptyNearestTiles(count)
+    for tileId in range(count):
+        match = matcher.find(tileId)
+        if not matcher.add(tileId):
+            # identical tile seen before, error 0 can't be beaten
+            setNearestTile(nearest, tileId, match, 0.0)
+            continue
 
-def parseSpriteTiles(image, options):
-    pos = getInitialSpritePosition(image, options)
-    tiles = []
-    while pos['y'] < image['resolutionY']:
-        pos['x'] = 0
-        while pos['x'] < image['resolutionX']:
-            if checkVlineFilled(image, pos, options):
-                tile = fetchTile(image, pos, options, len(tiles))
-                tiles.append({
-                    'id': len(tiles),
-                    'pixel': tile['pixel'],
-                    'palette': tile['palette'],
-                    'x': pos['x'],
-                    'y': pos['y'],
-                    'refId': None,
-                    'xMirror': False,
-                    'yMirror': False
-                })
-                pos['x'] += options.get('tilesizex')
-            else:
-                pos['x'] += 1
-        pos['y'] += options.get('tilesizey')
-    logging.info("parsed %s oam sprite tiles" % len(tiles))
-    return tiles
+        cell = tuple(cells[tileId].tolist())
+        candidates = [refId for offset in neighbourOffsets
+                      for refId in grid.get((cell[0]+offset[0], cell[1]+offset[1], cell[2]+offset[2]), ())]
+        grid.setdefault(cell, []).append(tileId)
+        if match:
+            # only mirrored duplicate
+            setNearestTile(nearest, tileId, match, 0.0)
+            continue
+        if not candidates:
+            continue
 
+        candidates = np.sort(np.array(candidates))
+        lowerBounds = np.sqrt(np.sum((signatures[candidates] - signatures[tileId]) ** 2, axis=1))
+        candidates = candidates[lowerBounds < cellSize]
+        if not len(candidates):
+            continue
 
-def checkVlineFilled(image, pos, options):
-    for ypos in range(pos['y'], pos['y']+options.get('tilesizey')):
-        if isPixelOpaque(image['pixels'], ypos, pos['x'], options):
-            return True
-    return False
+        errors = getTileErrors(mirrors[:, tileId], components[candidates])
+        minError = np.min(errors)
+        if minError < radius:
+            mirrorId, candidateId = np.unravel_index(np.argmin(errors), errors.shape)
+            setNearestTile(nearest, tileId, (candidates[candidateId], mirrorId), minError)
+    return nearest
 
 
-def isPixelOpaque(pixels, yPos, xPos, options):
-    return getPixel(pixels, yPos, xPos, options) != options.get('transcol')
+def getColorComponents(pixels):
+    '''splits snes colors into float32 (..., 3) r, g, b array'''
+    return COLOR_COMPONENTS_FLOAT[pixels]
 
 
-def getPixel(pixels, yPos, xPos, options):
-    try:
-        return pixels[yPos][xPos]
-    except IndexError:
-        return options.get('transcol')
-
-
-def getInitialSpritePosition(image, options):
-    for scanline in range(len(image['pixels'])):
-        for pixel in range(len(image['pixels'][scanline])):
-            if isPixelOpaque(image['pixels'], scanline, pixel, options):
-                return {
-                    'y': scanline,
-                    'x': getInitialLeftmostPixelSprite(image, scanline, options)
-                }
-    return {  # no match found, be stupid and loop anyway
-        'y': 0,
-        'x': 0
-    }
+def getTileErrors(mirrors, refs):
+    '''
+    weighted euclidean distance(see compareSNESColors) between (4, pixels, 3) mirrored tile and (N, pixels, 3) reference tiles,
+    returns (4, N) errors
+    '''
+    m_exp = mirrors[:, np.newaxis, :, :]
+    r_exp = refs[np.newaxis, :, :, :]
+
+    rm = (m_exp[..., 0] + r_exp[..., 0]) * 0.5
+    rd = m_exp[..., 0] - r_exp[..., 0]
+    gd = m_exp[..., 1] - r_exp[..., 1]
+    bd = m_exp[..., 2] - r_exp[..., 2]
 
+    # ((512+rm)*rd*rd)/256 + 4*gd*gd + ((767-rm)*bd*bd)/256
+    term1 = ((512 + rm) * rd * rd) / 256.0
+    term2 = 4 * gd * gd
+    term3 = ((767 - rm) * bd * bd) / 256.0
 
-def getInitialLeftmostPixelSprite(image, top, options):
-    x = INFINITY
-    for scanline in range(top, top + options.get('tilesizey')):
-        for pixel in range(len(image['pixels'][scanline])):
-            if isPixelOpaque(image['pixels'], scanline, pixel, options):
-                x = min(x, pixel)
-    return x
+    return np.sqrt(np.sum(term1 + term2 + term3, axis=2))
+
+
+def compareSNESColors(SNESCol1, SNESCol2):
+    r1, g1, b1 = SNESCol1 & 0x1f, (SNESCol1 & 0x3e0) >> 5, (SNESCol1 & 0x7c00) >> 10
+    r2, g2, b2 = SNESCol2 & 0x1f, (SNESCol2 & 0x3e0) >> 5, (SNESCol2 & 0x7c00) >> 10
+    redMean = (r1 + r2) // 2
+    r = r1 - r2
+    g = g1 - g2
+    b = b1 - b2
+    return math.sqrt((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8))
+
+
+def compareSNESColor(col1, col2):
+    return max(col1, col2) - min(col1, col2)
+
+
+def parseSpriteTiles(image, options):
+    '''
+    cut sprite tiles out of opaque image areas.
+    image is scanned in bands of tilesizey scanlines, starting at first opaque scanline.
+    within each band, tiles are placed left to right at each opaque pixel column not covered by the previous tile.
+    '''
+    tileWidth = options.get('tilesizex')
+    tileHeight = options.get('tilesizey')
+    transparent = options.get('transcol')
+    opaqueLines = np.flatnonzero((image['pixels'] != transparent).any(axis=1))
+    top = int(opaqueLines[0]) if len(opaqueLines) else 0
+    bandCount = -(-(image['resolutionY'] - top) // tileHeight)
+
+    # pad with transparent pixels, so bands and tiles never exceed image boundaries
+    pixels = np.full((top + bandCount * tileHeight, image['resolutionX'] + tileWidth), transparent, dtype=np.uint16)
+    pixels[:image['resolutionY'], :image['resolutionX']] = image['pixels']
+    opaqueColumns = (pixels[top:, :image['resolutionX']] != transparent).reshape(
+        bandCount, tileHeight, image['resolutionX']).any(axis=1)
+
+    xPos = []
+    yPos = []
+    for bandId, band in enumerate(opaqueColumns):
+        columns = np.flatnonzero(band)
+        column = 0
+        while column < len(columns):
+            xPos.append(int(columns[column]))
+            yPos.append(top + bandId * tileHeight)
+            column = int(np.searchsorted(columns, xPos[-1] + tileWidth))
+
+    xPos = np.array(xPos, dtype=np.int64)
+    yPos = np.array(yPos, dtype=np.int64)
+    tilePixels = pixels[yPos[:, np.newaxis, np.newaxis] + np.arange(tileHeight)[np.newaxis, :, np.newaxis],
+                        xPos[:, np.newaxis, np.newaxis] + np.arange(tileWidth)[np.newaxis, np.newaxis, :]]
+    logging.info("parsed %s oam sprite tiles" % len(xPos))
+    return TileSet(tilePixels, xPos, yPos)
 
 
 def parseBgTiles(image, options):
     '''normal bg tiles, parse whole image in tilesize-steps'''
-    pos = {
-        'x': 0,
-        'y': 0
-    }
-    tiles = []
-    while pos['y'] < image['resolutionY']:
-        pos['x'] = 0
-        while pos['x'] < image['resolutionX']:
-            tile = fetchTile(image, pos, options, len(tiles))
-            tiles.append({
-                'id': len(tiles),
-                'pixel': tile['pixel'],
-                'palette': tile['palette'],
-                'x': pos['x'],
-                'y': pos['y'],
-                'refId': None,
-                'xMirror': False,
-                'yMirror': False
-            })
-            pos['x'] += options.get('tilesizex')
-        pos['y'] += options.get('tilesizey')
-    return tiles
+    tileWidth = options.get('tilesizex')
+    tileHeight = options.get('tilesizey')
+    rows = image['resolutionY'] // tileHeight
+    columns = image['resolutionX'] // tileWidth
+    # (rows*tileHeight, columns*tileWidth) -> (rows*columns, tileHeight, tileWidth), tiles in scanline order
+    pixels = image['pixels'][:rows*tileHeight, :columns*tileWidth].reshape(
+        rows, tileHeight, columns, tileWidth).swapaxes(1, 2).reshape(rows*columns, tileHeight, tileWidth)
+    yPos, xPos = np.mgrid[0:rows*tileHeight:tileHeight, 0:columns*tileWidth:tileWidth]
+    return TileSet(pixels, xPos.ravel(), yPos.ravel())
 
 
-def fetchTile(image, pos, options, tileId):
-    tile = []
-    palette = [options.get('transcol')]
-    # logging.debug('fetching tile %s' % tileId)
-    for yPos in range(pos['y'], pos['y']+options.get('tilesizey')):
-        tileLine = []
-        for xPos in range(pos['x'], pos['x']+options.get('tilesizex')):
-            pixel = getPixel(image['pixels'], yPos, xPos, options)
-            tileLine.append(pixel)
-            if pixel not in palette:
-                palette.append(pixel)
-        tile.append(tileLine)
-    return {
-        'pixel': tile,
-        'palette': {
-            'id': tileId,
-            'color': palette,
-            'refId': None
-        }
-    }
+def getInputImage(options, filename):
+    return prepareInputImage(loadImage(filename), options)
 
 
-def getInputImage(options, filename):
+def loadImage(filename):
+    from PIL import Image
     # logging.debug('parsing input image.')
     try:
-        inputImage = Image.open(filename)
+        return Image.open(filename)
     except IOError:
         logging.error('Unable to load input image "%s"' % filename)
         sys.exit(1)
 
-    paddedImage = padImageReduceColdepth(inputImage, options)
-    options.set('resolutionx', paddedImage.size[0])
-    options.set('resolutiony', paddedImage.size[1])
+
+def prepareInputImage(inputImage, options):
+    if options.get('quantizer') in SNES_QUANTIZERS:
+        pixels = padImageQuantizeSnesColors(inputImage, options)
+    elif options.get('quantizer') == 'adaptive':
+        pixels = getSnesPixels(padImageReduceColdepth(inputImage, options))
+    else:
+        logging.error('Invalid quantizer %s, allowed are adaptive, %s.' % (options.get('quantizer'), ', '.join(SNES_QUANTIZERS)))
+        sys.exit(1)
+    options.set('resolutionx', pixels.shape[1])
+    options.set('resolutiony', pixels.shape[0])
 
     return {
-        'resolutionX': paddedImage.size[0],
-        'resolutionY': paddedImage.size[1],
-        'pixels': getSnesPixels(paddedImage)
+        'resolutionX': pixels.shape[1],
+        'resolutionY': pixels.shape[0],
+        'pixels': pixels
     }
 
 
 def getSnesPixels(image):
-    '''extract color-converted pixels from image'''
-    rawPixels = list(image.getdata())
-    outputPixels = []
-    idx = 0
-    width, height = image.size
-    for y in range(height):
-        row = []
-        for x in range(width):
-            row.append(convertColorRGBToSnes(rawPixels[idx]))
-            idx += 1
-        outputPixels.append(row)
-    return outputPixels
+    '''extract color-converted pixels from image, returns (height, width) uint16 array of 15bit snes colors'''
+    rgb = np.asarray(image.convert('RGB'), dtype=np.uint16)
+    return convertColorsRGBToSnes(rgb)
 
 
 def padImageReduceColdepth(inputImage, options):
     '''pad image to multiple of tilesize, fill blank areas with transparent color'''
+    from PIL import Image
     paddedWidth = inputImage.size[0] if (inputImage.size[0] % options.get('tilesizex') == 0) else (
         inputImage.size[0] - (inputImage.size[0] % options.get('tilesizex')) + options.get('tilesizex'))
     paddedHeight = inputImage.size[1] if (inputImage.size[1] % options.get('tilesizey') == 0) else (
@@ -1202,6 +1439,105 @@ def padImageReduceColdepth(inputImage, options):
     return reducedImage
 
 
+def padImageQuantizeSnesColors(inputImage, options):
+    '''
+    pad image to multiple of tilesize, fill blank areas with transparent color.
+    colors are reduced in 15bit snes color space, working on color histogram instead of pixels.
+    transparent color is kept as is, returns (height, width) uint16 array of snes colors.
+    '''
+    tileWidth = options.get('tilesizex')
+    tileHeight = options.get('tilesizey')
+    paddedHeight = -(-inputImage.size[1] // tileHeight) * tileHeight
+    paddedWidth = -(-inputImage.size[0] // tileWidth) * tileWidth
+    pixels = np.full((paddedHeight, paddedWidth), options.get('transcol'), dtype=np.uint16)
+    pixels[:inputImage.size[1], :inputImage.size[0]] = convertColorsRGBToSnes(np.asarray(inputImage.convert('RGB')))
+
+    colorCount = (((options.get('bpp') ** 2) - 1) * options.get('palettes'))
+    histogram = np.bincount(pixels.ravel(), minlength=len(SNES_COLORS))
+    histogram[options.get('transcol')] = 0
+    logging.info('Reducing %s colors to %s with %s.' % (np.count_nonzero(histogram), colorCount, options.get('quantizer')))
+    colorLookup = SNES_QUANTIZERS[options.get('quantizer')](histogram, colorCount)
+    colorLookup[options.get('transcol')] = options.get('transcol')
+    return colorLookup[pixels]
+
+
+def quantizeMedianCut(histogram, colorCount):
+    '''
+    median cut on (32768,) histogram of snes colors, returns (32768,) uint16 lookup table of reduced colors.
+    box holding most pixels times widest component range is split at its weighted median, until colorCount boxes exist.
+    each box is represented by weighted mean color of its entries.
+    '''
+    colors = np.flatnonzero(histogram)
+    lookup = SNES_COLORS.astype(np.uint16)
+    if len(colors) <= colorCount:
+        return lookup
+
+    boxes = [colors]
+    scores = [getMedianCutScore(colors, histogram)]
+    while len(boxes) < colorCount:
+        boxId = int(np.argmax(scores))
+        if scores[boxId] <= 0:
+            break
+        box = boxes.pop(boxId)
+        scores.pop(boxId)
+        components = COLOR_COMPONENTS_FLOAT[box]
+        axis = int(np.argmax(components.max(axis=0) - components.min(axis=0)))
+        box = box[np.argsort(components[:, axis], kind='stable')]
+        weights = np.cumsum(histogram[box])
+        split = int(np.clip(np.searchsorted(weights, weights[-1] / 2.0), 1, len(box) - 1))
+        boxes += [box[:split], box[split:]]
+        scores += [getMedianCutScore(box[:split], histogram), getMedianCutScore(box[split:], histogram)]
+
+    for box in boxes:
+        lookup[box] = getMeanSnesColor(box, histogram[box])
+    return lookup
+
+
+def getMedianCutScore(box, histogram):
+    '''pixel count times widest component range, boxes of single color can't be split'''
+    if len(box) < 2:
+        return -1
+    components = COLOR_COMPONENTS_FLOAT[box]
+    return histogram[box].sum() * (components.max(axis=0) - components.min(axis=0)).max()
+
+
+def quantizeKMeans(histogram, colorCount, iterations=16):
+    '''
+    weighted k-means on (32768,) histogram of snes colors, seeded with median cut colors.
+    distance is weighted like compareSNESColors, returns (32768,) uint16 lookup table of reduced colors.
+    '''
+    colors = np.flatnonzero(histogram)
+    lookup = quantizeMedianCut(histogram, colorCount)
+    if len(colors) <= colorCount:
+        return lookup
+
+    weights = histogram[colors]
+    components = COLOR_COMPONENTS_FLOAT[colors] * np.sqrt(MIN_COLOR_ERROR_WEIGHTS).astype(np.float32)
+    centroids = COLOR_COMPONENTS_FLOAT[np.unique(lookup[colors])] * np.sqrt(MIN_COLOR_ERROR_WEIGHTS).astype(np.float32)
+    assignment = None
+    for iteration in range(iterations):
+        # nearest centroid by squared distance, dropping |component|^2 which is the same for all centroids
+        nextAssignment = np.argmin((centroids ** 2).sum(axis=1)[np.newaxis, :] - 2 * (components @ centroids.T), axis=1)
+        if assignment is not None and np.array_equal(assignment, nextAssignment):
+            break
+        assignment = nextAssignment
+        clusterWeights = np.bincount(assignment, weights=weights, minlength=len(centroids))
+        used = clusterWeights > 0
+        for axis in range(3):
+            centroids[used, axis] = np.bincount(assignment, weights=weights * components[:, axis], minlength=len(centroids))[used] / clusterWeights[used]
+
+    for clusterId in np.unique(assignment):
+        members = colors[assignment == clusterId]
+        lookup[members] = getMeanSnesColor(members, histogram[members])
+    return lookup
+
+
+def getMeanSnesColor(colors, weights):
+    '''pixel count weighted mean of snes colors, rounded to nearest snes color'''
+    mean = np.round(np.average(COLOR_COMPONENTS_FLOAT[colors], axis=0, weights=weights)).astype(np.int64)
+    return mean[0] | (mean[1] << 5) | (mean[2] << 10)
+
+
 def convertColorSnesToRGB(inputColor):
     '''returns 16bit color list, format: (r,g,b)'''
     r = (inputColor & 0x1f) << 3
@@ -1214,6 +1550,13 @@ def convertColorSnesToRGB(inputColor):
     )
 
 
+def convertColorsSnesToRGB(colors):
+    '''vectorized convertColorSnesToRGB, returns (..., 3) uint8 array'''
+    colors = np.asarray(colors, dtype=np.uint16)
+    rgb = np.stack(((colors & 0x1f) << 3, (colors & 0x3e0) >> 2, (colors & 0x7c00) >> 7), axis=-1)
+    return (rgb | (rgb >> 5)).astype(np.uint8)
+
+
 def convertColorRGBToSnes(inputColor):
     '''returns 5bit color tuple, format: -bbbbbgg gggrrrrr'''
     return ((inputColor[0] & 0xf8) >> 3) | ((inputColor[1] & 0xf8) << 2) | ((inputColor[2] & 0xf8) << 7)
@@ -1222,98 +1565,224 @@ def convertColorRGBToSnes(inputColor):
     #  options['infile']['value'] = args.pop()    #before-last argument should be input filename
 
 
-class BitStream():
-    def __init__(self):
-        self.bitPos = 7
-        self.byte = 0
-        self.bitStream = []
+def convertColorsRGBToSnes(rgb):
+    '''vectorized convertColorRGBToSnes, takes (..., 3) array, returns uint16 array, format: -bbbbbgg gggrrrrr'''
+    rgb = rgb.astype(np.uint16, copy=False)
+    return (((rgb[..., 0] & 0xf8) >> 3) | ((rgb[..., 1] & 0xf8) << 2) | ((rgb[..., 2] & 0xf8) << 7)).astype(np.uint16)
 
-    def writeBit(self, bit):
-        self.byte |= (bit & 1) << self.bitPos
-        self.bitPos -= 1
-        if self.bitPos < 0:
-            self.bitStream.append(self.byte)
-            self.byte = 0
-            self.bitPos = 7
 
-    def get(self):
-        return self.bitStream
+class TileSet():
+    '''
+    flat tile store, one row per tile in all arrays.
+    pixel holds 15bit snes colors (N, tilesizey, tilesizex), indexedPixel the palette indices of those.
+    refId is NO_REFERENCE for actual tiles, else id of tile this one is a (possibly mirrored) duplicate of.
+    '''
+    def __init__(self, pixel, x, y):
+        count = len(pixel)
+        self.pixel = np.ascontiguousarray(pixel, dtype=np.uint16)
+        self.indexedPixel = np.zeros(self.pixel.shape, dtype=np.uint8)
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.refId = np.full(count, NO_REFERENCE, dtype=np.int32)
+        self.paletteId = np.arange(count, dtype=np.int32)
+        self.xMirror = np.zeros(count, dtype=bool)
+        self.yMirror = np.zeros(count, dtype=bool)
+        self.outId = np.full(count, NO_REFERENCE, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.pixel)
+
+    def copy(self):
+        tiles = TileSet.__new__(TileSet)
+        tiles.__dict__ = {name: array.copy() for name, array in self.__dict__.items()}
+        return tiles
+
+    def actualCount(self):
+        return int(np.count_nonzero(self.refId == NO_REFERENCE))
+
+    def getColors(self):
+        '''all colors of all tiles, in order of first appearance'''
+        pixels = self.pixel.ravel()
+        colors, firstIndices = np.unique(pixels, return_index=True)
+        return colors[np.argsort(firstIndices)].tolist()
+
+    def getColorHistogram(self):
+        '''all colors of all tiles and their pixel counts, in order of first appearance'''
+        colors, firstIndices, counts = np.unique(self.pixel.ravel(), return_index=True, return_counts=True)
+        order = np.argsort(firstIndices)
+        return colors[order], counts[order]
+
+
+class IdenticalTileMatcher():
+    '''finds first preceding tile identical to any mirrored variant of a tile'''
+    def __init__(self, tiles):
+        self.mirrors = [np.ascontiguousarray(mirror) for mirror in getMirroredPixels(tiles.pixel)]
+        self.firstOccurrence = {}
+
+    def find(self, tileId):
+        '''returns (refId, mirrorId) or None'''
+        for mirrorId, mirror in enumerate(self.mirrors):
+            refId = self.firstOccurrence.get(mirror[tileId].tobytes())
+            if refId is not None:
+                return (refId, mirrorId)
+        return None
+
+    def add(self, tileId):
+        '''returns False if identical tile has been added before'''
+        key = self.mirrors[MIRROR_NONE][tileId].tobytes()
+        if key in self.firstOccurrence:
+            return False
+        self.firstOccurrence[key] = tileId
+        return True
 
-    def first(self):
-        return self.bitStream.pop(0)
 
-    def notEmpty(self):
-        return len(self.bitStream) > 0
+class StageProfiler():
+    '''
+    records duration, memory use & counters of pipeline stages as list of dicts.
+    peak memory of each stage is known while tracemalloc is tracing, peak rss of whole process is recorded either way.
+    '''
+    def __init__(self, job):
+        self.job = job
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, message=None):
+        '''times enclosed block, yields record dict for stage counters. message is logged along with duration'''
+        record = {'job': self.job, 'stage': name}
+        # tracing is started through the tracemalloc module, no need to import it if nobody else did
+        tracemalloc = sys.modules.get('tracemalloc')
+        if tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        yield record
+        record['seconds'] = time.perf_counter() - t0
+        if tracemalloc and tracemalloc.is_tracing():
+            record['peakMemory'] = tracemalloc.get_traced_memory()[1]
+        if resource:
+            # kilobytes on linux
+            record['maxRss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.records.append(record)
+        if message:
+            logging.info(f"{message} in {record['seconds']:.2f}s")
+
+
+class ConversionCache():
+    '''
+    on-disk store of conversion output streams, one file per entry.
+    entries are keyed by hash of input pixels and all options affecting output,
+    least recently used entries are evicted once cache exceeds maxSize megabytes.
+    '''
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize * 0x100000
+
+    def getKey(self, image, options):
+        import hashlib
+        digest = hashlib.sha256()
+        digest.update(repr((CACHE_VERSION, [(name, options.get(name)) for name in CACHE_KEY_OPTIONS])).encode())
+        self.updateDigest(digest, image)
+        if options.get('refpalette'):
+            self.updateDigest(digest, loadImage(options.get('refpalette')))
+        return digest.hexdigest()
+
+    def updateDigest(self, digest, image):
+        digest.update(repr((image.mode, image.size, image.getpalette())).encode())
+        digest.update(image.tobytes())
+
+    def getEntryFile(self, key):
+        return os.path.join(self.path, '%s.cache' % key)
+
+    def load(self, key):
+        '''returns ({extension: bytes}, Statistics) or None'''
+        import pickle
+        try:
+            with open(self.getEntryFile(key), 'rb') as entry:
+                cached = pickle.load(entry)
+            # modification time tracks last use for eviction
+            os.utime(self.getEntryFile(key))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return cached
+
+    def store(self, key, streams, stats):
+        import pickle
+        tempFile = '%s.%s.tmp' % (self.getEntryFile(key), os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tempFile, 'wb') as entry:
+                pickle.dump((streams, stats), entry, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFile, self.getEntryFile(key))
+        except OSError:
+            logging.warning('unable to store conversion in cache %s.' % self.path)
+
+    def evict(self):
+        '''deletes least recently used entries until cache fits maxSize, returns number of evicted entries'''
+        entries = []
+        try:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.cache'):
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        except OSError:
+            # cache folder or entries may be removed by concurrent conversions
+            pass
+        cacheSize = sum([size for mtime, size, path in entries])
+        evicted = 0
+        for mtime, size, path in sorted(entries):
+            if cacheSize <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except OSError:
+                pass
+            cacheSize -= size
+        return evicted
 
 
 class Statistics():
     def __init__(self, tiles, palettes, startTime):
         self.totalTiles = len(tiles)
-        self.actualTiles = len(
-            [tile for tile in tiles if tile['refId'] == None])
+        self.actualTiles = tiles.actualCount()
         self.actualPalettes = len(
             [pal for pal in palettes if pal['refId'] == None])
         self.timeWasted = time.perf_counter() - startTime
+        self.cached = False
+        self.psnr = None
+        self.stages = []
 
 
-class ColObj():
-    def __init__(self, snesCol):
-        self.r = snesCol & 0x1f
-        self.g = (snesCol & 0x3E0) >> 5
-        self.b = (snesCol & 0x7C00) >> 10
-
-    def getLightness(self):
-        r = self.r / float(0x1f)
-        g = self.g / float(0x1f)
-        b = self.b / float(0x1f)
-
-        cmin = min(r, g, b)
-        cmax = max(r, g, b)
-        return (cmax + cmin) / 2
-
-    def getSaturation(self):
-        r = self.r / float(0x1f)
-        g = self.g / float(0x1f)
-        b = self.b / float(0x1f)
-
-        cmin = min(r, g, b)
-        cmax = max(r, g, b)
-        cdelta = cmax - cmin
-        if cdelta == 0:
-            return 0
-        clight = (cmax + cmin) / 2
-        return cdelta / (cmax + cmin) if clight < 0.5 else cdelta / (2 - cmax - cmin)
-
-    def getHue(self):
-        r = self.r / float(0x1f)
-        g = self.g / float(0x1f)
-        b = self.b / float(0x1f)
-
-        cmin = min(r, g, b)
-        cmax = max(r, g, b)
-        cdelta = cmax - cmin
-        if cdelta == 0:
-            return 0
-        clight = (cmax + cmin) / 2
-        csaturation = cdelta / \
-            (cmax + cmin) if clight < 0.5 else cdelta / (2 - cmax - cmin)
+def getColorHues(red, green, blue):
+    '''vectorized hsl hue of 5bit r, g, b component arrays, range 0-1'''
+    r = red / float(0x1f)
+    g = green / float(0x1f)
+    b = blue / float(0x1f)
 
+    cmin = np.minimum(np.minimum(r, g), b)
+    cmax = np.maximum(np.maximum(r, g), b)
+    cdelta = cmax - cmin
+    with np.errstate(divide='ignore', invalid='ignore'):
         rdelta = (((cmax-r)/6)+(cdelta/2)) / cdelta
         gdelta = (((cmax-g)/6)+(cdelta/2)) / cdelta
         bdelta = (((cmax-b)/6)+(cdelta/2)) / cdelta
 
-        if r == cmax:
-            chue = bdelta - gdelta
-        elif g == cmax:
-            chue = (1.0/3.0) + rdelta - bdelta
-        elif b == cmax:
-            chue = (2.0/3.0) + gdelta - rdelta
-
-        if chue < 0:
-            chue += 1
-        if chue > 1:
-            chue -= 1
-        return chue
+    chue = np.where(r == cmax, bdelta - gdelta,
+                    np.where(g == cmax, (1.0/3.0) + rdelta - bdelta, (2.0/3.0) + gdelta - rdelta))
+    chue = np.where(chue < 0, chue + 1, chue)
+    chue = np.where(chue > 1, chue - 1, chue)
+    return np.where(cdelta == 0, 0.0, chue)
+
+
+# lookup tables for all 15bit snes colors: -bbbbbgg gggrrrrr
+SNES_COLORS = np.arange(0x8000, dtype=np.int64)
+COLOR_RED = SNES_COLORS & 0x1f
+COLOR_GREEN = (SNES_COLORS & 0x3e0) >> 5
+COLOR_BLUE = (SNES_COLORS & 0x7c00) >> 10
+COLOR_COMPONENTS_FLOAT = np.stack((COLOR_RED, COLOR_GREEN, COLOR_BLUE), axis=1).astype(np.float32)
+
+SNES_QUANTIZERS = {
+    'mediancut': quantizeMedianCut,
+    'kmeans': quantizeKMeans
+}
 
 
 def debugLog(data, message=''):
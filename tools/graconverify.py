@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+'''
+verifies gracon output files against their source images.
+decodes .tiles, .tilemap(.spritemap) and .palette files the way the snes displays them
+and reports error metrics of the reconstructed image per file.
+
+takes same jobs & conversion options as gracon, so outputs are checked with the options they were converted with:
+-infile       source image, -outfilebase output file base(default: infile base)
+-manifest     check all jobs listed in file, one line of gracon options per image
+-batch        check all images matching glob, -outfilebase is used as output folder, mirroring input paths
+-jobs         worker processes, 0 uses all cores(default: 1)
+-minpsnr      minimum acceptable psnr in dB(default: 0, off)
+
+exit status is 1 if any output is missing, malformed, references nonexistent tiles/palettes or falls short of -minpsnr.
+
+example, check all video frames of build tree:
+  python graconverify.py -bpp 4 -palettes 8 -mode bg -jobs 0 -batch 'data/**/*.gfx_video.png' -outfilebase build
+'''
+
+import os
+import sys
+import time
+import numpy as np
+import userOptions
+import gracon
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# size of one 32x32 entry bg tilemap
+BG_TILEMAP_BYTES = gracon.BG_TILEMAP_SIZE * gracon.BG_TILEMAP_SIZE * 2
+
+OPTION_DEFAULTS = dict(gracon.OPTION_DEFAULTS, **{
+    'minpsnr': {
+        'value': 0.0,
+        'type': 'float',
+        'max': 1000.0,
+        'min': 0.0
+    },
+})
+
+
+def main():
+    if len(sys.argv) == 1 or any(arg in sys.argv for arg in ['-h', '--help', '-help']):
+        print(__doc__)
+        sys.exit(0)
+
+    options = userOptions.Options(sys.argv, OPTION_DEFAULTS)
+    if not (options.get('infile') or options.get('manifest') or options.get('batch')):
+        print(__doc__)
+        sys.exit(1)
+
+    sys.exit(0 if verifyBatch(options, sys.argv) else 1)
+
+
+def verifyBatch(options, args):
+    '''verifies output of all jobs, returns False if any output failed verification'''
+    t0 = time.perf_counter()
+    if options.get('manifest') or options.get('batch'):
+        jobs = [[args[0]] + jobArgs for jobArgs in gracon.getBatchJobs(options, args)]
+    else:
+        jobs = [args]
+    processCount = min(options.get('jobs') or os.cpu_count() or 1, len(jobs))
+
+    if processCount > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processCount)
+        results = pool.imap(verifyJob, jobs)
+    else:
+        pool = None
+        results = (verifyJob(jobArgs) for jobArgs in jobs)
+
+    failed = []
+    psnrs = []
+    try:
+        for outfilebase, metrics in results:
+            if 'error' in metrics:
+                logging.error('%s: %s' % (outfilebase, metrics['error']))
+                failed.append(outfilebase)
+                continue
+            psnrs.append(metrics['psnr'])
+            status = 'ok' if metrics['passed'] else 'FAILED'
+            logging.info('%s: %s, psnr %.2f dB, max error %s, %s invalid tile references, %s invalid palette references' % (
+                outfilebase, status, metrics['psnr'], metrics['maxError'], metrics['invalidTiles'], metrics['invalidPalettes']))
+            if not metrics['passed']:
+                failed.append(outfilebase)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    logging.info('verified %s of %s outputs in %.2f seconds, %s failed.%s' % (
+        len(psnrs), len(jobs), time.perf_counter() - t0, len(failed),
+        ' psnr min %.2f dB, mean %.2f dB.' % (min(psnrs), np.mean(psnrs)) if psnrs else ''))
+    return not failed
+
+
+def verifyJob(args):
+    '''
+    decodes and checks output of single job, returns (outfilebase, metrics).
+    safe to run in worker processes, failures are returned as metrics['error'] instead of exiting.
+    '''
+    outfilebase = ' '.join(args[1:])
+    try:
+        options = userOptions.Options(args, OPTION_DEFAULTS)
+        gracon.applyImplicitOptions(options)
+        outfilebase = options.get('outfilebase')
+        sourceImage = gracon.loadImage(options.get('infile'))
+        return outfilebase, getErrorMetrics(readOutputStreams(options), sourceImage, options)
+    except SystemExit:
+        return outfilebase, {'error': 'unable to load job'}
+    except (OSError, ValueError) as error:
+        return outfilebase, {'error': str(error)}
+
+
+def readOutputStreams(options):
+    '''returns {extension: bytes} of output files required to reconstruct image'''
+    extensions = ['tiles', ('tilemap', 'spritemap') if options.get('mode') == 'sprite' else ('tilemap',)]
+    if not options.get('directcolor'):
+        extensions.append('palette')
+
+    streams = {}
+    for extension in extensions:
+        candidates = (extension,) if isinstance(extension, str) else extension
+        for candidate in candidates:
+            fileName = '%s.%s' % (options.get('outfilebase'), candidate)
+            if os.path.exists(fileName):
+                with open(fileName, 'rb') as streamFile:
+                    streams[candidates[0]] = streamFile.read()
+                break
+        else:
+            raise OSError('missing output file %s.%s' % (options.get('outfilebase'), candidates[0]))
+    return streams
+
+
+def getErrorMetrics(streams, sourceImage, options):
+    '''
+    reconstructs image from output streams, returns dict of metrics:
+    psnr & max channel error against source image, count of tilemap entries referencing nonexistent tiles/palettes
+    '''
+    tileWidth = options.get('tilesizex')
+    tileHeight = options.get('tilesizey')
+    image = {
+        'resolutionX': -(-sourceImage.size[0] // tileWidth) * tileWidth,
+        'resolutionY': -(-sourceImage.size[1] // tileHeight) * tileHeight,
+    }
+    tileSize = tileWidth * tileHeight * options.get('bpp') // 8
+    if len(streams['tiles']) % tileSize:
+        raise ValueError('tile file size %s is no multiple of tile size %s' % (len(streams['tiles']), tileSize))
+    entrySize = 4 if options.get('mode') == 'sprite' else BG_TILEMAP_BYTES
+    if len(streams['tilemap']) % entrySize:
+        raise ValueError('tilemap file size %s is no multiple of %s' % (len(streams['tilemap']), entrySize))
+
+    xPos, yPos, configs = gracon.decodeTileMapStream(streams['tilemap'], image, options)
+    invalidTiles = int(np.count_nonzero((configs & 0x3ff) >= len(streams['tiles']) // tileSize))
+    invalidPalettes = 0
+    if not options.get('directcolor'):
+        paletteCount = len(streams['palette']) // (2 * options.get('bpp') ** 2)
+        invalidPalettes = int(np.count_nonzero(gracon.getTileMapPaletteIds(configs, options) >= paletteCount))
+
+    sample = gracon.convertColorsSnesToRGB(gracon.renderOutputStreams(streams, image, options))
+    source = np.asarray(sourceImage.convert('RGB'), dtype=np.int16)
+    maxError = int(np.abs(sample[:source.shape[0], :source.shape[1]] - source).max()) if source.size else 0
+    psnr = gracon.getPsnr(sample, sourceImage)
+    return {
+        'psnr': psnr,
+        'maxError': maxError,
+        'invalidTiles': invalidTiles,
+        'invalidPalettes': invalidPalettes,
+        'passed': not invalidTiles and not invalidPalettes and psnr >= options.get('minpsnr')
+    }
+
+
+if __name__ == "__main__":
+    main()
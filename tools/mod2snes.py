@@ -225,7 +225,7 @@ def writeSamples( outFile, sampleBufferPos, instruments ):
       
       outFile.write(bytes((header ,)))
       for i in range( 8 ):
-        outFile.write(bytes((mergeBrrSample( i, sampleBlock['samples'] ,))) )
+        outFile.write(bytes((mergeBrrSample( i, sampleBlock['samples'] ),)))
   return samplePointer
 
 
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+'''
+benchmarks the asset conversion tools on deterministic synthetic inputs, so it runs offline and gives comparable
+numbers between changes to the tools.
+every benchmark runs the tool the way the makefile does (separate python process, same flags) and reports
+throughput(frames/s, samples/s or MB/s), best wall time of all repeats and peak resident memory.
+
+benchmarks:
+  gracon-bg             4bpp bg images, 8 palettes
+  gracon-directcolor    8bpp direct color images
+  gracon-sprite         4bpp sprite sheets with transparent background
+  gracon-video          4bpp video frames limited to 512 tiles
+  animationwriter-bg    animations of all data/backgrounds/*.gfx_bg folders
+  mod2snes              synthetic 4 channel protracker module
+  msu1blockwriter       synthetic chapters of video frames & audio
+  startup               import of every tool module in a fresh interpreter, paid by each makefile invocation
+
+options:
+-only         comma separated list of benchmarks to run(default: all)
+-repeat       runs per benchmark, best time is reported(default: 3)
+-baseline     json file of previous results to compare against
+-save         on: write results to -baseline instead of comparing(default: off)
+-tolerance    percentage a benchmark may be slower than baseline before it counts as regression(default: 10)
+-importtime   list this many slowest imports of each tool module, as reported by python -X importtime(default: 0, off)
+-workdir      folder for synthetic inputs & outputs, kept after run(default: temporary folder, removed after run)
+
+exit status is 1 if any tool fails or, when comparing, any benchmark regressed beyond -tolerance.
+
+example, save baseline, then compare after changing gracon:
+  python toolbenchmark.py -baseline .benchmark_baseline.json -save on
+  python toolbenchmark.py -baseline .benchmark_baseline.json -only gracon-bg,gracon-video
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+import numpy as np
+from PIL import Image
+import userOptions
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+
+BASELINE_VERSION = 1
+
+# mirror gfx_*_flags of makefile
+GRACON_FLAGS = {
+    'bg': '-verify off -optimize on -tilethreshold 15 -palettes 8 -bpp 4 -mode bg',
+    'directcolor': '-verify off -optimize on -directcolor on -tilethreshold 10 -palettes 1 -bpp 8 -mode bg',
+    'video': '-verify off -optimize on -tilethreshold 13 -maxtiles 512 -palettes 8 -bpp 4 -mode bg',
+    'sprite': '-verify off -optimize on -tilethreshold 10 -palettes 2 -bpp 4 -mode sprite',
+}
+
+# snes rgb of default gracon transparent color 0x7C1F
+TRANSPARENT_RGB = (248, 0, 248)
+
+MOD_HEADER_SIZE = 1084
+MOD_PATTERN_SIZE = 1024
+MOD_INSTRUMENTS = 31
+# amiga periods of octave 1-3 C, E, G, all present in mod2snes period lut
+MOD_PERIODS = (856, 678, 570, 428, 339, 285, 214, 170, 143)
+
+SEED = 0x5eed
+
+# modules imported by startup benchmark & -importtime report
+STARTUP_MODULES = ('gracon', 'animationWriter', 'graconverify', 'mod2snes', 'msu1blockwriter', 'msu1pcmwriter')
+
+OPTION_DEFAULTS = {
+    'only': {
+        'value': '',
+        'type': 'str'
+    },
+    'repeat': {
+        'value': 3,
+        'type': 'int',
+        'max': 100,
+        'min': 1
+    },
+    'baseline': {
+        'value': '',
+        'type': 'str'
+    },
+    'save': {
+        'value': False,
+        'type': 'bool'
+    },
+    'tolerance': {
+        'value': 10.0,
+        'type': 'float',
+        'max': 1000.0,
+        'min': 0.0
+    },
+    'importtime': {
+        'value': 0,
+        'type': 'int',
+        'max': 1000,
+        'min': 0
+    },
+    'workdir': {
+        'value': '',
+        'type': 'str'
+    },
+}
+
+
+def main():
+    if any(arg in sys.argv for arg in ['-h', '--help', '-help']):
+        print(__doc__)
+        sys.exit(0)
+
+    options = userOptions.Options(sys.argv, OPTION_DEFAULTS)
+    benchmarks = getBenchmarks(options)
+    if options.get('save') and not options.get('baseline'):
+        logging.error('-save on requires a -baseline file to write results to.')
+        sys.exit(1)
+
+    if sys.dont_write_bytecode and ('startup' in dict(benchmarks) or options.get('importtime')):
+        logging.warning('Bytecode caching is disabled(PYTHONDONTWRITEBYTECODE), startup times include compiling tools.')
+
+    workdir = options.get('workdir') or tempfile.mkdtemp(prefix='toolbenchmark')
+    try:
+        results = runBenchmarks(benchmarks, workdir, options)
+    finally:
+        if not options.get('workdir'):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if not results:
+        sys.exit(1)
+
+    if options.get('importtime'):
+        logImportTimes(options.get('importtime'))
+
+    if options.get('save'):
+        writeBaseline(results, options.get('baseline'))
+        logging.info('Saved results of %s benchmarks as baseline %s.' % (len(results), options.get('baseline')))
+        sys.exit(0)
+
+    baseline = readBaseline(options.get('baseline')) if options.get('baseline') else {}
+    sys.exit(0 if logResults(results, baseline, options) else 1)
+
+
+def getBenchmarks(options):
+    '''returns [(name, setup function)] of benchmarks selected by -only'''
+    benchmarks = [
+        ('gracon-bg', setupGraconBg),
+        ('gracon-directcolor', setupGraconDirectColor),
+        ('gracon-sprite', setupGraconSprite),
+        ('gracon-video', setupGraconVideo),
+        ('animationwriter-bg', setupAnimationWriterBg),
+        ('mod2snes', setupMod2Snes),
+        ('msu1blockwriter', setupMsu1BlockWriter),
+        ('startup', setupStartup),
+    ]
+    if not options.get('only'):
+        return benchmarks
+    names = [name.strip() for name in options.get('only').split(',') if name.strip()]
+    unknown = [name for name in names if name not in dict(benchmarks)]
+    if unknown:
+        logging.error('Unknown benchmark %s, available: %s' % (', '.join(unknown), ', '.join(dict(benchmarks))))
+        sys.exit(1)
+    return [benchmark for benchmark in benchmarks if benchmark[0] in names]
+
+
+def runBenchmarks(benchmarks, workdir, options):
+    '''
+    runs all benchmarks, returns {name: result} or None if any tool failed.
+    setup functions return (commands, amount, unit), amount of processed units is divided by best time of all repeats.
+    '''
+    results = {}
+    for name, setup in benchmarks:
+        benchmarkDir = os.path.join(workdir, name)
+        os.makedirs(benchmarkDir, exist_ok=True)
+        commands, amount, unit = setup(benchmarkDir)
+
+        times = []
+        maxRss = 0
+        for _ in range(options.get('repeat')):
+            seconds = 0.0
+            for command in commands:
+                commandSeconds, commandRss = runCommand(command, benchmarkDir)
+                if commandSeconds is None:
+                    return None
+                seconds += commandSeconds
+                maxRss = max(maxRss, commandRss or 0)
+            times.append(seconds)
+
+        best = min(times)
+        results[name] = {
+            'unit': unit,
+            'amount': amount,
+            'seconds': best,
+            'throughput': amount / best if best else 0.0,
+            'maxRss': maxRss or None
+        }
+    return results
+
+
+def runCommand(command, workdir):
+    '''runs tool in separate process, returns (wall seconds, peak rss bytes) or (None, None) if tool failed'''
+    with tempfile.TemporaryFile() as logFile:
+        t0 = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, stdout=logFile, stderr=logFile)
+        maxRss = None
+        if hasattr(os, 'wait4'):
+            # rusage of this child only, RUSAGE_CHILDREN would report largest child so far
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            maxRss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+        seconds = time.perf_counter() - t0
+
+        if process.returncode:
+            logFile.seek(0)
+            logging.error('Benchmark command failed with exit status %s: %s\n%s' % (
+                process.returncode, ' '.join(command), logFile.read().decode('utf-8', 'replace')))
+            return None, None
+    return seconds, maxRss
+
+
+def getToolCommand(tool, *args):
+    return [sys.executable, os.path.join(TOOLS_DIR, tool)] + list(args)
+
+
+def getGraconCommand(images, workdir, flags):
+    '''returns gracon command converting all images in single process, same as the makefile video manifest rule'''
+    manifestFileName = os.path.join(workdir, 'manifest.txt')
+    with open(manifestFileName, 'w') as manifestFile:
+        for image in images:
+            manifestFile.write('%s -infile %s -outfilebase %s\n' % (flags, image, os.path.splitext(image)[0]))
+    return getToolCommand('gracon.py', '-jobs', '1', '-manifest', manifestFileName)
+
+
+def setupGraconBg(workdir):
+    images = writeSyntheticImages(workdir, 'bg', 4, 256, 224, getSyntheticScene)
+    return [getGraconCommand(images, workdir, GRACON_FLAGS['bg'])], len(images), 'frames'
+
+
+def setupGraconDirectColor(workdir):
+    images = writeSyntheticImages(workdir, 'directcolor', 4, 256, 224, getSyntheticScene)
+    return [getGraconCommand(images, workdir, GRACON_FLAGS['directcolor'])], len(images), 'frames'
+
+
+def setupGraconSprite(workdir):
+    images = writeSyntheticImages(workdir, 'sprite', 8, 128, 64, getSyntheticSprite)
+    return [getGraconCommand(images, workdir, GRACON_FLAGS['sprite'])], len(images), 'frames'
+
+
+def setupGraconVideo(workdir):
+    images = writeSyntheticImages(workdir, 'video', 8, 256, 160, getSyntheticVideoFrame)
+    return [getGraconCommand(images, workdir, GRACON_FLAGS['video'])], len(images), 'frames'
+
+
+def setupAnimationWriterBg(workdir):
+    folders = sorted(glob.glob(os.path.join(REPO_DIR, 'data', 'backgrounds', '*.gfx_bg')))
+    commands = [getToolCommand('animationWriter.py', *GRACON_FLAGS['bg'].split(), '-infolder', folder,
+                               '-outfile', os.path.join(workdir, '%s.animation' % os.path.basename(folder)))
+                for folder in folders]
+    frames = len([name for folder in folders for name in os.listdir(folder)
+                  if os.path.splitext(name)[1] in ('.png', '.gif', '.bmp')])
+    return commands, frames, 'frames'
+
+
+def setupMod2Snes(workdir):
+    module, samples = getSyntheticModule(np.random.RandomState(SEED))
+    moduleFileName = os.path.join(workdir, 'synthetic.mod')
+    with open(moduleFileName, 'wb') as moduleFile:
+        moduleFile.write(module)
+    return [getToolCommand('mod2snes.py', moduleFileName, os.path.join(workdir, 'synthetic'))], samples, 'samples'
+
+
+def setupMsu1BlockWriter(workdir):
+    chapterDir = os.path.join(workdir, 'chapters')
+    inputBytes = writeSyntheticChapters(chapterDir, np.random.RandomState(SEED))
+    command = getToolCommand('msu1blockwriter.py', '-title', 'BENCHMARK', '-infilebase', chapterDir,
+                             '-outfile', os.path.join(workdir, 'benchmark.msu'))
+    return [command], inputBytes / (1024.0 * 1024.0), 'MB'
+
+
+def setupStartup(workdir):
+    commands = [[sys.executable, '-c', getImportStatement(module)] for module in STARTUP_MODULES]
+    return commands, len(commands), 'starts'
+
+
+def getImportStatement(module):
+    return 'import sys; sys.path.insert(0, %r); import %s' % (TOOLS_DIR, module)
+
+
+def logImportTimes(count):
+    '''logs total import time and slowest imports by self time of every tool module'''
+    for module in STARTUP_MODULES:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', getImportStatement(module)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        imports = []
+        total = 0
+        # import time: self [us] | cumulative | imported package
+        for line in result.stderr.splitlines():
+            fields = line[len('import time:'):].split('|') if line.startswith('import time:') else []
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            imports.append((int(fields[0]), name))
+            if name == module:
+                total = int(fields[1])
+        slowest = sorted(imports, reverse=True)[:count]
+        logging.info('%s imports in %.1fms, slowest: %s' % (module, total / 1000.0, ', '.join(
+            ['%s %.1fms' % (name, selfTime / 1000.0) for selfTime, name in slowest])))
+
+
+def writeSyntheticImages(workdir, name, count, width, height, getter):
+    '''writes count png frames generated by getter(random, width, height, frame), returns their file names'''
+    random = np.random.RandomState(SEED)
+    fileNames = []
+    for frame in range(count):
+        fileName = os.path.join(workdir, '%s.%03d.png' % (name, frame))
+        Image.fromarray(getter(random, width, height, frame), 'RGB').save(fileName)
+        fileNames.append(fileName)
+    return fileNames
+
+
+def getSyntheticScene(random, width, height, frame):
+    '''smooth gradients overlaid with flat colored rectangles and some noise, similar to converted screenshots'''
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // width, y * 255 // height, (x + y + frame * 16) * 255 // (width + height)], axis=-1)
+    for _ in range(24):
+        x0, y0 = random.randint(0, width), random.randint(0, height)
+        image[y0:y0 + random.randint(8, 64), x0:x0 + random.randint(8, 96)] = random.randint(0, 256, 3)
+    image = image + random.randint(-6, 7, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def getSyntheticSprite(random, width, height, frame):
+    '''colored blobs on transparent background, like sprite animation sheets'''
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = TRANSPARENT_RGB
+    y, x = np.mgrid[0:height, 0:width]
+    for _ in range(6):
+        cx, cy, radius = random.randint(0, width), random.randint(0, height), random.randint(6, 24)
+        mask = (x - cx) ** 2 + (y - cy) ** 2 < radius ** 2
+        shade = np.clip(255 - (np.abs(x - cx) + np.abs(y - cy)) * 4, 32, 255)[..., None]
+        image[mask] = (random.randint(0, 128, 3) + shade * random.randint(64, 128, 3) // 256)[mask]
+    return image
+
+
+def getSyntheticVideoFrame(random, width, height, frame):
+    '''scrolling textured scene, consecutive frames share most content like real video'''
+    y, x = np.mgrid[0:height, 0:width]
+    scrollX = x + frame * 6
+    texture = ((scrollX // 16 + y // 16) % 2) * 96 + (np.sin(scrollX / 11.0) * np.cos(y / 7.0) * 64).astype(np.int64)
+    image = np.stack([texture + 64, texture + y * 96 // height, 160 - texture // 2], axis=-1)
+    image = image + random.randint(-10, 11, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def getSyntheticModule(random, patternCount=4, instrumentCount=8, instrumentLength=4096):
+    '''returns (protracker M.K. module bytes, number of sample bytes) with looping & one shot instruments'''
+    header = bytearray(MOD_HEADER_SIZE)
+    header[0:20] = b'synthetic benchmark'.ljust(20, b'\x00')
+
+    sampleData = bytearray()
+    for instrument in range(MOD_INSTRUMENTS):
+        offset = 20 + instrument * 30
+        header[offset:offset + 22] = (b'instrument %02d' % instrument).ljust(22, b'\x00')
+        if instrument >= instrumentCount:
+            continue
+        t = np.arange(instrumentLength)
+        wave = np.sin(t * 2 * np.pi * (instrument + 1) / 64.0) * 100 * np.exp(-t / (instrumentLength * 0.7))
+        wave = wave + random.randint(-8, 9, instrumentLength)
+        sampleData += np.clip(wave, -128, 127).astype(np.int8).tobytes()
+        header[offset + 22:offset + 24] = (instrumentLength // 2).to_bytes(2, 'big')
+        header[offset + 25] = 64
+        if instrument % 2:
+            header[offset + 26:offset + 28] = (instrumentLength // 4).to_bytes(2, 'big')
+            header[offset + 28:offset + 30] = (instrumentLength // 4).to_bytes(2, 'big')
+
+    header[950] = patternCount + 1
+    header[951] = 127
+    for position in range(patternCount + 1):
+        header[952 + position] = position
+    header[1080:1084] = b'M.K.'
+
+    patterns = bytearray(MOD_PATTERN_SIZE * (patternCount + 1))
+    for cell in range(0, len(patterns), 4):
+        if random.randint(0, 3):
+            continue
+        instrument = random.randint(1, instrumentCount + 1)
+        period = MOD_PERIODS[random.randint(0, len(MOD_PERIODS))]
+        patterns[cell:cell + 4] = bytes(((instrument & 0xf0) | (period >> 8), period & 0xff,
+                                         (instrument & 0xf) << 4, 0))
+    return bytes(header + patterns + sampleData), len(sampleData)
+
+
+def writeSyntheticChapters(chapterDir, random, chapterCount=3, frameCount=24, audioSeconds=2):
+    '''writes chapter folders of video frame tiles, tilemaps, palettes & pcm audio, returns total input bytes'''
+    inputBytes = 0
+    for chapter in range(chapterCount):
+        path = os.path.join(chapterDir, 'chapter%02d' % chapter)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'chapter.id.%d' % chapter), 'w') as idFile:
+            idFile.write('%d\n' % chapter)
+        for frame in range(frameCount):
+            frameBase = os.path.join(path, 'frame.%04d.gfx_video' % frame)
+            streams = {
+                'tiles': random.randint(0, 256, 512 * 32).astype(np.uint8).tobytes(),
+                'tilemap': random.randint(0, 512, 32 * 20).astype('<u2').tobytes(),
+                'palette': random.randint(0, 0x8000, 8 * 16).astype('<u2').tobytes(),
+            }
+            for extension, stream in streams.items():
+                with open('%s.%s' % (frameBase, extension), 'wb') as streamFile:
+                    streamFile.write(stream)
+                inputBytes += len(stream)
+        audio = random.randint(-0x8000, 0x8000, 44100 * 2 * audioSeconds).astype('<i2').tobytes()
+        with open(os.path.join(path, 'chapter.sfx_video.pcm'), 'wb') as audioFile:
+            audioFile.write(audio)
+        inputBytes += len(audio)
+    return inputBytes
+
+
+def writeBaseline(results, fileName):
+    with open(fileName, 'w') as baselineFile:
+        json.dump({
+            'version': BASELINE_VERSION,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'benchmarks': results
+        }, baselineFile, indent=2, sort_keys=True)
+        baselineFile.write('\n')
+
+
+def readBaseline(fileName):
+    '''returns {name: result} of baseline file, empty if missing or written by incompatible version'''
+    try:
+        with open(fileName) as baselineFile:
+            baseline = json.load(baselineFile)
+    except (OSError, ValueError):
+        logging.warning('Unable to read baseline %s, reporting results without comparison.' % fileName)
+        return {}
+    if baseline.get('version') != BASELINE_VERSION:
+        logging.warning('Baseline %s has incompatible version %s, reporting results without comparison.' % (
+            fileName, baseline.get('version')))
+        return {}
+    return baseline.get('benchmarks', {})
+
+
+def logResults(results, baseline, options):
+    '''logs results & change against baseline, returns False if any benchmark regressed beyond tolerance'''
+    regressions = []
+    for name, result in results.items():
+        line = '%-20s %10.2f %s/s %8.2fs %8s' % (
+            name, result['throughput'], result['unit'], result['seconds'],
+            '%.1fMB' % (result['maxRss'] / (1024.0 * 1024.0)) if result['maxRss'] else '-')
+        reference = baseline.get(name)
+        if reference and reference.get('throughput'):
+            change = (result['throughput'] / reference['throughput'] - 1.0) * 100.0
+            line += '  %+6.1f%% vs baseline' % change
+            if change < -options.get('tolerance'):
+                line += ', REGRESSION'
+                regressions.append(name)
+        logging.info(line)
+
+    if regressions:
+        logging.error('%s benchmarks slower than baseline by more than %.1f%%: %s' % (
+            len(regressions), options.get('tolerance'), ', '.join(regressions)))
+    return not regressions
+
+
+if __name__ == "__main__":
+    main()